@@ -1,8 +1,33 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import SimpleITK as sitk
 from pathlib import Path  
-from radiomics.featureextractor import *
+
+# SimpleITK and pyradiomics are imported lazily: they take seconds to load
+
+from dtype_policy import DEFAULT_POLICY
+from cache import RadiomicsCache, extractor_params, radiomics_key
+
+# Shared by every extract_radiomics call that does not pass its own extractor / cache
+_default_extractor = None
+_default_cache = None
+
+
+def get_default_extractor():
+    """RadiomicsFeatureExtractor with the default settings, built once per process."""
+    global _default_extractor
+    if _default_extractor is None:
+        from radiomics.featureextractor import RadiomicsFeatureExtractor
+        _default_extractor = RadiomicsFeatureExtractor()
+    return _default_extractor
+
+
+def enable_radiomics_cache(path="data/cache/radiomics.sqlite", max_bytes=1024 ** 3):
+    """
+    Memoize every extract_radiomics call of this process in a persistent RadiomicsCache.
+    Returns the cache (use ``cache.stats()`` for the hit/miss counters).
+    """
+    global _default_cache
+    _default_cache = RadiomicsCache(path, max_bytes)
+    return _default_cache
 
 def load_npy(file_path) : 
     return np.load(file_path)
@@ -11,31 +36,51 @@ def numpy_to_sitk(np_array):
     """
     Convierte un arreglo NumPy en un objeto SimpleITK.Image.
     """
+    import SimpleITK as sitk
     return sitk.GetImageFromArray(np_array)
 
-def extract_radiomics(scan_array, mask_array):
+def extract_radiomics(scan_array, mask_array, policy=None, extractor=None, cache=None, spacing=None):
     """
     Extract radiomic features for a specific nodule using pyradiomics.
+    The scan is handed to SimpleITK in ``policy.compute_dtype`` (float32 by default).
+    Pass an ``extractor`` to reuse an already configured RadiomicsFeatureExtractor.
+    With a ``cache`` (RadiomicsCache, or the one set by enable_radiomics_cache) the result is
+    memoized by a hash of the image, the mask, the spacing and the extractor settings.
+    ``spacing`` (x, y[, z]) in mm is set on the SimpleITK images when given.
     Returns:
-    Dictionary of radiomic features.
+    Dictionary of radiomic features. With a cache, always in its JSON-decoded form (floats / lists),
+    whether it was a hit or a miss.
     """
-    # Convertir los arrays NumPy a objetos SimpleITK
-    scan_sitk = numpy_to_sitk(scan_array)
+    policy = policy or DEFAULT_POLICY
+    extractor = extractor or get_default_extractor()
+    cache = cache or _default_cache
 
+    scan_array = policy.to_compute(scan_array)
     # Convertir la máscara booleana (True/False) a una máscara entera (1/0)
     mask_array_int = mask_array.astype(np.uint8)
-    mask_sitk = numpy_to_sitk(mask_array_int)
 
-    # Configurar el extractor de radiomics
-    extractor = RadiomicsFeatureExtractor()
+    if cache is not None:
+        key = radiomics_key(scan_array, mask_array_int, spacing, extractor_params(extractor))
+        features = cache.get(key)
+        if features is not None:
+            return features
+
+    # Convertir los arrays NumPy a objetos SimpleITK
+    scan_sitk = numpy_to_sitk(scan_array)
+    mask_sitk = numpy_to_sitk(mask_array_int)
+    if spacing is not None:
+        scan_sitk.SetSpacing([float(s) for s in spacing])
+        mask_sitk.SetSpacing([float(s) for s in spacing])
 
     # Extraer las características
     features = extractor.execute(scan_sitk, mask_sitk)
 
+    if cache is not None:
+        features = cache.put(key, features)
     return features
 
 
-def process_nodule_images_masks(pid, nodules_annotation, vol, consensus_func, calculate_malignancy_func, IMAGE_DIR="data/image", MASK_DIR="data/mask", mask_threshold=8, prefix="prefix"):
+def process_nodule_images_masks(pid, nodules_annotation, vol, consensus_func, calculate_malignancy_func, IMAGE_DIR="data/image", MASK_DIR="data/mask", mask_threshold=8, prefix="prefix", policy=None):
     """
     Procesa y guarda las imágenes y máscaras de los nódulos de un paciente, basado en sus anotaciones.
 
@@ -49,7 +94,9 @@ def process_nodule_images_masks(pid, nodules_annotation, vol, consensus_func, ca
     - MASK_DIR: Directorio para guardar las máscaras.
     - mask_threshold: Umbral mínimo de píxeles en una máscara para ser considerado un nódulo válido.
     - prefix: Prefijo para nombrar las imágenes y máscaras.
+    - policy: DtypePolicy; los slices se guardan en HU ``policy.storage_dtype`` (int16 por defecto).
     """
+    policy = policy or DEFAULT_POLICY
     # Crear los directorios para almacenar imágenes y máscaras
     patient_image_dir = Path(IMAGE_DIR) / pid
     patient_mask_dir = Path(MASK_DIR) / pid
@@ -82,8 +129,8 @@ def process_nodule_images_masks(pid, nodules_annotation, vol, consensus_func, ca
                 nodule_name = "{}_NI{}_slice{}".format(pid[-4:], prefix[nodule_idx], prefix[nodule_slice])
                 mask_name = "{}_MA{}_slice{}".format(pid[-4:], prefix[nodule_idx], prefix[nodule_slice])
                 
-                # Guardamos la imagen original y la máscara
-                np.save(patient_image_dir / nodule_name, lung_original_slice)
+                # Guardamos la imagen original (HU int16) y la máscara
+                np.save(patient_image_dir / nodule_name, policy.to_storage(lung_original_slice))
                 np.save(patient_mask_dir / mask_name, mask[:, :, nodule_slice])
                 
                 # Meta información (puedes almacenarla en otro lugar si es necesario)
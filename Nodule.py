@@ -1,8 +1,6 @@
 import numpy as np
-import pylidc as pl
 from statistics import median_high
 import inspect
-import pandas as pd
 
 class AverageNodule():
     def __init__(self, nodule_id, annotation_list,patient_id):
@@ -123,14 +121,74 @@ class AverageNodule():
         return data
 
     
+def eager_scan_query(query):
+    """
+    Add eager loading of annotations and their contours to a pylidc Scan query.
+
+    Without it every scan.annotations and annotation.contours access (cluster_annotations,
+    consensus, boolean_mask, ...) is a separate round-trip to the pylidc database.
+    """
+    import pylidc as pl
+    from sqlalchemy.orm import selectinload
+
+    return query.options(selectinload(pl.Scan.annotations).selectinload(pl.Annotation.contours))
+
+
+def prefetch_scans(pids, chunk_size=500, eager=True):
+    """
+    Fetch the scans of many patients, with their annotations and contours, in a few queries.
+
+    Parameters:
+    - pids: List of patient IDs (LIDC-IDRI-XXXX).
+    - chunk_size: Patients per query (keeps the IN clause under the SQLite parameter limit).
+    - eager: Also load annotations and contours (eager_scan_query). False when only scan columns are needed.
+
+    Returns:
+    - dict: patient ID -> fully loaded pylidc Scan (the first scan of the patient, as query(...).first()).
+      Patients without scan are missing from the dict.
+    """
+    import pylidc as pl
+
+    pids = list(pids)
+    scans = {}
+    for start in range(0, len(pids), chunk_size):
+        query = pl.query(pl.Scan).filter(pl.Scan.patient_id.in_(pids[start:start + chunk_size])).order_by(pl.Scan.id)
+        for scan in (eager_scan_query(query) if eager else query):
+            scans.setdefault(scan.patient_id, scan)
+    return scans
+
+
+def iter_scans(pids, chunk_size=50):
+    """
+    Iterate ``(pid, scan)`` in the order of ``pids``, prefetching ``chunk_size`` patients at a time.
+    ``scan`` is None for patients that are not in the pylidc database.
+    """
+    pids = list(pids)
+    for start in range(0, len(pids), chunk_size):
+        chunk = pids[start:start + chunk_size]
+        scans = prefetch_scans(chunk, chunk_size)
+        for pid in chunk:
+            yield pid, scans.get(pid)
+
+
 # Base class for managing LIDC queries and scans
 class LIDCBase():
-    def __init__(self, pid):
+    def __init__(self, pid, scan=None):
         self.pid = pid
-        self.scan = None
+        self.scan = scan
+
+    @classmethod
+    def prefetch(cls, pids, chunk_size=500):
+        """
+        Batch version of query_scan: returns ``{pid: instance}`` with the scans (annotations and
+        contours included) already loaded, so iterating them does not touch the database again.
+        """
+        scans = prefetch_scans(pids, chunk_size)
+        return {pid: cls(pid, scans[pid]) for pid in pids if pid in scans}
 
     def query_scan(self):
         """Query and return the scan for the given patient ID."""
+        import pylidc as pl
         self.scan = pl.query(pl.Scan).filter(pl.Scan.patient_id == self.pid).first()
         if not self.scan:
             raise ValueError(f"No scan found for patient ID {self.pid}")
@@ -140,14 +198,17 @@ class LIDCBase():
 # Derived class PyLIDC with additional functionalities
 class PyLIDC(LIDCBase):
     
-    def __init__(self, pid):
-        super().__init__(pid)
+    def __init__(self, pid, scan=None):
+        super().__init__(pid, scan)
+        self.nodules = None
 
     def get_nodules(self):
         """Return the list of nodules for the queried scan."""
         if not self.scan:
             self.query_scan()  # Ensure the scan is queried
-        return self.scan.cluster_annotations()  # This will cluster annotations as nodules via euclidian distance
+        if self.nodules is None:
+            self.nodules = self.scan.cluster_annotations()  # This will cluster annotations as nodules via euclidian distance
+        return self.nodules
 
     def get_nodule_count(self):
         """Return the number of nodules in the scan."""
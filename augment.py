@@ -0,0 +1,445 @@
+import argparse
+import copy
+import json
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from dtype_policy import DEFAULT_POLICY, DtypePolicy
+from utils import clip_hu_range, normalize_hu
+
+# HU given to the background of the segmented slices, to the padding and to the pixels warped in from outside
+AIR_HU = -1000
+BACKENDS = ('thread', 'process')
+# is_cancer of meta_info.csv (see calculate_malignancy) -> label code; 'Ambiguous' is malignancy 3
+CANCER_LABELS = {'True': 1, 'False': 0, 'Ambiguous': -1}
+
+
+def cancer_labels(is_cancer):
+    """
+    Label codes of the is_cancer column: 1 cancer, 0 not cancer, -1 ambiguous.
+
+    With 'Ambiguous' in the column pandas reads it as strings, so values are matched by their
+    text instead of being cast to bool (any non-empty string is True).
+    """
+    labels = is_cancer.astype(str).map(CANCER_LABELS)
+    if labels.isna().any():
+        raise ValueError("Unknown is_cancer values: {}".format(sorted(set(is_cancer[labels.isna()].astype(str)))))
+    return labels.to_numpy(dtype=np.int8)
+
+
+def crop_or_pad(image, size, fill=0):
+    """Center crop / pad a 2D slice to (size, size)."""
+    out = np.full((size, size), fill, dtype=image.dtype)
+    rows, cols = min(image.shape[0], size), min(image.shape[1], size)
+    src_row, src_col = (image.shape[0] - rows) // 2, (image.shape[1] - cols) // 2
+    dst_row, dst_col = (size - rows) // 2, (size - cols) // 2
+    out[dst_row:dst_row + rows, dst_col:dst_col + cols] = image[src_row:src_row + rows, src_col:src_col + cols]
+    return out
+
+
+class SliceLoader:
+    """
+    Stacked (B, H, W) batches of the slices listed in meta_info.csv.
+
+    The images saved by MakeDataSet are standardized segment_lung outputs; with the
+    standardization stats kept in dtype_policy.json they are brought back to approximate
+    HU (filtered, AIR_HU outside the lung, see DtypePolicy), so the augmentation can
+    apply the HU window itself. Slices are center cropped / padded to ``size``. Clean rows
+    are read from the clean directories; virtual clean rows (``is_virtual``) are drawn from
+    the volumes by ``clean_sampler``, and ``for_epoch`` redraws them for every epoch
+    (AugmentedBatches.iter_epoch does it).
+    """
+
+    def __init__(self, meta, image_dir, mask_dir, normalization, clean_image_dir=None, clean_mask_dir=None,
+                 clean_sampler=None, size=512, policy=None):
+        self.meta = meta.reset_index(drop=True)
+        self.labels = cancer_labels(self.meta['is_cancer'])
+        self.image_dir = Path(image_dir)
+        self.mask_dir = Path(mask_dir)
+        self.clean_image_dir = Path(clean_image_dir) if clean_image_dir else None
+        self.clean_mask_dir = Path(clean_mask_dir) if clean_mask_dir else None
+        self.normalization = normalization
+        self.clean_sampler = clean_sampler
+        self.size = size
+        self.policy = policy or DEFAULT_POLICY
+        self._epoch = None
+
+    @classmethod
+    def from_meta(cls, meta_path, image_dir, mask_dir, **kwargs):
+        """Loader over meta_info.csv, with the policy and normalization of dtype_policy.json (same directory)."""
+        import pandas as pd
+
+        meta_path = Path(meta_path)
+        meta = pd.read_csv(meta_path / 'meta_info.csv', dtype={'patient_id': str})
+        with open(meta_path / 'dtype_policy.json', 'r') as f:
+            saved = json.load(f)
+        kwargs.setdefault('policy', DtypePolicy.from_dict(saved['policy']))
+        return cls(meta, image_dir, mask_dir, saved['normalization'], **kwargs)
+
+    def __len__(self):
+        return len(self.meta)
+
+    def for_epoch(self, epoch):
+        """
+        Loader of ``epoch``: the virtual clean rows are replaced by ``clean_sampler.sample(epoch)``, a
+        new reproducible negative set (epoch 0 is the draw written to meta_info.csv). The other rows
+        are unchanged. Returns ``self`` when there is no sampler or no virtual row.
+        """
+        if self.clean_sampler is None or 'is_virtual' not in self.meta or not self.meta['is_virtual'].any():
+            return self
+        if self._epoch is None or self._epoch[0] != epoch:
+            import pandas as pd
+
+            kept = self.meta[~self.meta['is_virtual'].astype(bool)]
+            loader = copy.copy(self)
+            loader.meta = pd.concat([kept, self.clean_sampler.sample(epoch)], ignore_index=True)
+            loader.labels = cancer_labels(loader.meta['is_cancer'])
+            loader._epoch = None
+            self._epoch = (epoch, loader)
+        return self._epoch[1]
+
+    def __getstate__(self):
+        # Sent to worker processes: they redraw their own epoch loader (for_epoch)
+        state = self.__dict__.copy()
+        state['_epoch'] = None
+        return state
+
+    def _read(self, row):
+        """Standardized image, mask and standardization stats of one meta_info.csv row."""
+        name = row['original_image']
+        if row.get('is_virtual', False):
+            from clean_sampler import parse_clean_name
+
+            if self.clean_sampler is None:
+                raise ValueError("{} is a virtual clean slice: a clean_sampler is needed to load it".format(name))
+            image, mask = self.clean_sampler.load(name)
+            stats = self.normalization.get(name)
+            if stats is None:
+                # Virtual slices are not in dtype_policy.json: same stats as segment_lung computes
+                pid, z = parse_clean_name(name)
+                hu_slice = self.policy.to_compute(self.clean_sampler.volume(pid)[:, :, z])
+                stats = {'mean': float(np.mean(hu_slice)), 'std': float(np.std(hu_slice))}
+            return image, mask, stats
+        if row['is_clean']:
+            # Clean names already start with the patient directory
+            pid = name.split('/')[0]
+            image = np.load(self.clean_image_dir / pid / (name + '.npy'))
+            mask = np.load(self.clean_mask_dir / pid / (row['mask_image'] + '.npy'))
+        else:
+            pid = "LIDC-IDRI-{}".format(str(row['patient_id']).zfill(4))
+            image = np.load(self.image_dir / pid / (name + '.npy'))
+            mask = np.load(self.mask_dir / pid / (row['mask_image'] + '.npy'))
+        return image, mask, self.normalization[name]
+
+    def load(self, idx):
+        """HU image (``policy.compute_dtype``) and boolean mask of row ``idx``, both (size, size)."""
+        image, mask, stats = self._read(self.meta.iloc[idx])
+        image = self.policy.to_compute(image)
+        outside = image == 0
+        image = image * np.asarray(stats['std'], dtype=image.dtype) + np.asarray(stats['mean'], dtype=image.dtype)
+        image[outside] = AIR_HU
+        return crop_or_pad(image, self.size, AIR_HU), crop_or_pad(np.asarray(mask, dtype=bool), self.size, False)
+
+    def load_batch(self, indices):
+        """
+        Returns:
+        - tuple: (images (B, size, size) in HU, masks (B, size, size) bool, labels (B,) from cancer_labels).
+        """
+        images = np.empty((len(indices), self.size, self.size), dtype=self.policy.compute_dtype)
+        masks = np.empty((len(indices), self.size, self.size), dtype=bool)
+        for i, idx in enumerate(indices):
+            images[i], masks[i] = self.load(idx)
+        return images, masks, self.labels[np.asarray(indices, dtype=np.int64)]
+
+
+class BatchAugmenter:
+    """
+    Random augmentation of a whole (B, H, W) batch of HU images and their nodule masks.
+
+    Every transform is drawn per sample but applied with vectorized ops over the batch:
+    - left-right flips (``flip_prob``) with one np.where;
+    - rot90 with the batch grouped by k (needs square slices, see SliceLoader);
+    - rotation (up to ``max_rotation`` degrees) and elastic deformation (Simard et al.:
+      displacement = ``elastic_alpha`` * gaussian_filter(U(-1, 1), ``elastic_sigma``), 0 disables it)
+      composed into one sampling grid, resampled by a single map_coordinates call over the batch
+      (linear for the images, nearest for the masks, so masks stay binary and aligned);
+    - HU window jitter: the window center moves by up to ``window_jitter`` HU and its width by up to
+      ``width_jitter`` (fraction) around [min_hu, max_hu], applied through clip_hu_range / normalize_hu
+      with per-sample bounds.
+
+    The output images are normalized to [0, 1] in ``policy.compute_dtype``. ``augment`` draws from
+    ``np.random.default_rng([seed, epoch, batch_idx])``, so a batch is reproducible whatever the
+    worker that produces it.
+    """
+
+    def __init__(self, flip_prob=0.5, rot90=True, max_rotation=15.0, elastic_alpha=0.0, elastic_sigma=10.0,
+                 window_jitter=50.0, width_jitter=0.1, min_hu=-1000, max_hu=400, seed=42, policy=None):
+        self.flip_prob = flip_prob
+        self.rot90 = rot90
+        self.max_rotation = max_rotation
+        self.elastic_alpha = elastic_alpha
+        self.elastic_sigma = elastic_sigma
+        self.window_jitter = window_jitter
+        self.width_jitter = width_jitter
+        self.min_hu = min_hu
+        self.max_hu = max_hu
+        self.seed = seed
+        self.policy = policy or DEFAULT_POLICY
+
+    def augment(self, images, masks, epoch=0, batch_idx=0):
+        return self.apply(images, masks, np.random.default_rng([self.seed, epoch, batch_idx]))
+
+    def apply(self, images, masks, rng):
+        """
+        Parameters:
+        - images: (B, H, W) HU images.
+        - masks: (B, H, W) nodule masks.
+        - rng: np.random.Generator.
+
+        Returns:
+        - tuple: (normalized images, boolean masks), both (B, H, W).
+        """
+        images = self.policy.to_compute(images)
+        masks = np.asarray(masks, dtype=bool)
+        batch_size = len(images)
+
+        flip = (rng.random(batch_size) < self.flip_prob)[:, None, None]
+        images = np.where(flip, images[:, :, ::-1], images)
+        masks = np.where(flip, masks[:, :, ::-1], masks)
+
+        if self.rot90:
+            if images.shape[1] != images.shape[2]:
+                raise ValueError("rot90 needs square slices, got {}".format(images.shape[1:]))
+            k = rng.integers(0, 4, batch_size)
+            for turns in range(1, 4):
+                idx = np.flatnonzero(k == turns)
+                if len(idx):
+                    images[idx] = np.rot90(images[idx], turns, axes=(1, 2))
+                    masks[idx] = np.rot90(masks[idx], turns, axes=(1, 2))
+
+        if self.max_rotation or self.elastic_alpha:
+            from scipy.ndimage import map_coordinates
+
+            coordinates = self.sample_coordinates(images.shape, rng)
+            images = map_coordinates(images, coordinates, output=images.dtype, order=1, mode='constant', cval=AIR_HU)
+            masks = map_coordinates(masks.view(np.uint8), coordinates, order=0, mode='constant', cval=0) > 0
+
+        center = (self.min_hu + self.max_hu) / 2 + rng.uniform(-self.window_jitter, self.window_jitter, batch_size)
+        width = (self.max_hu - self.min_hu) * (1 + rng.uniform(-self.width_jitter, self.width_jitter, batch_size))
+        # Per-sample window bounds, broadcast over (H, W); cast so the batch stays in compute_dtype
+        min_hu = (center - width / 2).astype(self.policy.compute_dtype)[:, None, None]
+        max_hu = (center + width / 2).astype(self.policy.compute_dtype)[:, None, None]
+        images = normalize_hu(clip_hu_range(images, min_hu, max_hu), min_hu, max_hu, self.policy)
+        return images, masks
+
+    def sample_coordinates(self, shape, rng):
+        """(3, B, H, W) source coordinates (batch, row, column) of the rotation + elastic deformation of every sample."""
+        from scipy.ndimage import gaussian_filter
+
+        batch_size, height, width = shape
+        dtype = self.policy.compute_dtype
+        rows, cols = np.meshgrid(np.arange(height, dtype=dtype) - (height - 1) / 2,
+                                 np.arange(width, dtype=dtype) - (width - 1) / 2, indexing='ij')
+        theta = np.deg2rad(rng.uniform(-self.max_rotation, self.max_rotation, batch_size)).astype(dtype)[:, None, None]
+        cos, sin = np.cos(theta), np.sin(theta)
+        src_rows = cos * rows - sin * cols + (height - 1) / 2
+        src_cols = sin * rows + cos * cols + (width - 1) / 2
+        if self.elastic_alpha:
+            for coordinate in (src_rows, src_cols):
+                # One smooth displacement field per sample (no smoothing along the batch axis)
+                field = rng.uniform(-1, 1, shape).astype(dtype)
+                coordinate += gaussian_filter(field, sigma=(0, self.elastic_sigma, self.elastic_sigma)) * self.elastic_alpha
+        # Integer batch coordinate: each sample is only interpolated from itself
+        batch = np.broadcast_to(np.arange(batch_size, dtype=dtype)[:, None, None], shape)
+        return np.stack([batch, src_rows, src_cols])
+
+
+def augment_batch(loader, augmenter, indices, epoch, batch_idx):
+    """Load and augment one batch. Returns (images, masks, labels)."""
+    images, masks, labels = loader.load_batch(indices)
+    images, masks = augmenter.augment(images, masks, epoch, batch_idx)
+    return images, masks, labels
+
+
+# Loader and augmenter of the worker processes (see _init_worker)
+_PIPELINE = None
+
+
+def _init_worker(loader, augmenter):
+    global _PIPELINE
+    _PIPELINE = (loader, augmenter)
+
+
+def _augment_job(indices, epoch, batch_idx):
+    # The draw of an epoch is reproducible: each worker redraws the same virtual rows
+    return augment_batch(_PIPELINE[0].for_epoch(epoch), _PIPELINE[1], indices, epoch, batch_idx)
+
+
+class AugmentedBatches:
+    """
+    Augmented training batches produced in the background, ahead of the training loop.
+
+    ``workers`` threads (backend='thread') or spawned processes (backend='process') load and
+    augment the batches, and at most ``prefetch`` finished or running batches wait ahead of the
+    consumer. Batches are yielded in order; their composition (``seed``, ``epoch``, the virtual
+    clean rows of SliceLoader.for_epoch) and their augmentation (BatchAugmenter.augment) do not
+    depend on the backend or the number of workers.
+    Use the process backend when the threads contend for the GIL (e.g. many small batches);
+    it costs pickling every batch back to the training process.
+
+    for images, masks, labels in batches.iter_epoch(epoch):
+        ...
+    """
+
+    def __init__(self, loader, augmenter, batch_size=32, shuffle=True, drop_last=False, seed=42,
+                 workers=2, prefetch=4, backend='thread'):
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of {}".format(BACKENDS))
+        self.loader = loader
+        self.augmenter = augmenter
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.workers = workers
+        self.prefetch = max(prefetch, workers)
+        self.backend = backend
+        self.pool = None
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.loader) // self.batch_size
+        return -(-len(self.loader) // self.batch_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_epoch(0)
+
+    def batch_indices(self, epoch=0):
+        """Row indices (of ``loader.for_epoch(epoch)``) of every batch of an epoch."""
+        n_rows = len(self.loader.for_epoch(epoch))
+        order = np.arange(n_rows)
+        if self.shuffle:
+            order = np.random.default_rng([self.seed, epoch]).permutation(order)
+        stop = n_rows // self.batch_size * self.batch_size if self.drop_last else n_rows
+        return [order[start:start + self.batch_size] for start in range(0, stop, self.batch_size)]
+
+    def _submit(self, indices, epoch, batch_idx):
+        if self.pool is None:
+            if self.backend == 'thread':
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            else:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_init_worker, initargs=(self.loader, self.augmenter))
+        if self.backend == 'thread':
+            return self.pool.submit(augment_batch, self.loader.for_epoch(epoch), self.augmenter, indices, epoch, batch_idx)
+        return self.pool.submit(_augment_job, indices, epoch, batch_idx)
+
+    def iter_epoch(self, epoch=0):
+        """Yields ``(images, masks, labels)`` batches of ``epoch``."""
+        pending = deque()
+        try:
+            for batch_idx, indices in enumerate(self.batch_indices(epoch)):
+                pending.append(self._submit(indices, epoch, batch_idx))
+                if len(pending) >= self.prefetch:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Consumer stopped early: drop the batches that did not start
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def synthetic_batch(batch_size, size=512, seed=0):
+    """Random HU slices (lung-like background) with one disc-shaped nodule each, for benchmarking."""
+    rng = np.random.default_rng(seed)
+    images = rng.normal(-800, 100, (batch_size, size, size)).astype(np.float32)
+    rows, cols = np.ogrid[:size, :size]
+    centers = rng.integers(size // 4, 3 * size // 4, (batch_size, 2))
+    radii = rng.integers(3, 15, batch_size)
+    masks = ((rows - centers[:, 0, None, None]) ** 2 + (cols - centers[:, 1, None, None]) ** 2) <= radii[:, None, None] ** 2
+    images[masks] = rng.normal(40, 30, int(masks.sum()))
+    return images, masks
+
+
+def _throughput(n_samples, seconds):
+    return n_samples / seconds if seconds > 0 else float('inf')
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Augmentation throughput: per-sample loop vs batched, and with background workers')
+    arg_parser.add_argument('--meta', default=None, help='Directory of meta_info.csv / dtype_policy.json (synthetic slices if not given)')
+    arg_parser.add_argument('--config', default='lung.conf')
+    arg_parser.add_argument('--batch-size', type=int, default=32)
+    arg_parser.add_argument('--batches', type=int, default=20)
+    arg_parser.add_argument('--size', type=int, default=512)
+    arg_parser.add_argument('--workers', type=int, default=4)
+    arg_parser.add_argument('--backend', choices=BACKENDS, default='thread')
+    arg_parser.add_argument('--elastic-alpha', type=float, default=0.0)
+    arg_parser.add_argument('--model-rate', type=float, default=None, help='Samples/s consumed by the model, to compare against')
+    args = arg_parser.parse_args()
+
+    augmenter = BatchAugmenter(elastic_alpha=args.elastic_alpha)
+
+    images, masks = synthetic_batch(args.batch_size, args.size)
+    start = time.perf_counter()
+    for batch_idx in range(args.batches):
+        for i in range(args.batch_size):
+            augmenter.augment(images[i:i + 1], masks[i:i + 1], 0, batch_idx * args.batch_size + i)
+    loop_rate = _throughput(args.batches * args.batch_size, time.perf_counter() - start)
+    start = time.perf_counter()
+    for batch_idx in range(args.batches):
+        augmenter.augment(images, masks, 0, batch_idx)
+    batch_rate = _throughput(args.batches * args.batch_size, time.perf_counter() - start)
+    print("Per-sample loop: {:.1f} samples/s".format(loop_rate))
+    print("Batched:         {:.1f} samples/s ({:.1f}x)".format(batch_rate, batch_rate / loop_rate))
+
+    if args.meta:
+        from configparser import ConfigParser
+        from cache import VolumeCache
+        from clean_sampler import CLEAN_PATIENTS_FILE, CleanSliceSampler
+
+        parser = ConfigParser()
+        parser.read(args.config)
+        clean_sampler = None
+        if (Path(args.meta) / CLEAN_PATIENTS_FILE).exists():
+            volume_cache = VolumeCache(parser.get('prepare_dataset', 'VOLUME_CACHE_PATH', fallback='data/cache/volume'))
+            clean_sampler = CleanSliceSampler.from_meta(args.meta, volume_cache=volume_cache,
+                                                        mode=parser.get('prepare_dataset', 'Clean_Sampling', fallback='uniform'),
+                                                        n_per_patient=parser.getint('prepare_dataset', 'Clean_Per_Patient', fallback=51),
+                                                        seed=parser.getint('prepare_dataset', 'Clean_Seed', fallback=42))
+        loader = SliceLoader.from_meta(args.meta, parser.get('prepare_dataset', 'IMAGE_PATH'),
+                                       parser.get('prepare_dataset', 'MASK_PATH'),
+                                       clean_image_dir=parser.get('prepare_dataset', 'CLEAN_PATH_IMAGE'),
+                                       clean_mask_dir=parser.get('prepare_dataset', 'CLEAN_PATH_MASK'),
+                                       clean_sampler=clean_sampler, size=args.size)
+        with AugmentedBatches(loader, augmenter, args.batch_size, workers=args.workers, backend=args.backend) as batches:
+            n_samples = 0
+            start = time.perf_counter()
+            for batch_idx, (images, masks, labels) in enumerate(batches):
+                n_samples += len(images)
+                if batch_idx + 1 >= args.batches:
+                    break
+            pipeline_rate = _throughput(n_samples, time.perf_counter() - start)
+        print("Loader + augmentation ({} {} workers): {:.1f} samples/s".format(args.workers, args.backend, pipeline_rate))
+    else:
+        pipeline_rate = batch_rate
+    if args.model_rate is not None:
+        print("Model consumes {:.1f} samples/s: augmentation is {}".format(
+            args.model_rate, 'ahead' if pipeline_rate >= args.model_rate else 'the bottleneck'))
@@ -0,0 +1,66 @@
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Pipeline modules whose import cost is paid by every worker process / CLI run
+MODULES = ['dtype_policy', 'utils', 'Mask', 'Nodule', 'data_viz', 'prepare_dataset']
+
+# numpy is the only dependency expected to be loaded at import time
+BASELINE = 'numpy'
+
+
+def time_import(module, repeat=5):
+    """
+    Measure the import time of a module in fresh interpreters.
+
+    Args:
+        module (str): Module name to import.
+        repeat (int, optional): Number of fresh interpreters to launch. Default is 5.
+
+    Returns:
+        float: Best wall time in milliseconds for ``import module``.
+    """
+    code = ("import time; t = time.perf_counter(); import {}; "
+            "print((time.perf_counter() - t) * 1000)").format(module)
+    times = []
+    for _ in range(repeat):
+        # prepare_dataset reads lung.conf at import, run it from the repository directory
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=REPO_DIR)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def heavy_modules_loaded(module):
+    """Return the heavy third-party packages that end up in sys.modules after importing ``module``."""
+    heavy = ['pylidc', 'radiomics', 'SimpleITK', 'sklearn', 'skimage', 'scipy', 'medpy',
+             'pydicom', 'pandas', 'matplotlib', 'seaborn', 'xgboost']
+    code = ("import sys; import {}; "
+            "print(','.join(m for m in {!r} if m in sys.modules))").format(module, heavy)
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=REPO_DIR)
+    return [m for m in out.stdout.strip().split(',') if m]
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Startup time benchmark for the pipeline modules')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--budget-ms', type=float, default=200.0, help='Maximum accepted import time')
+    args = arg_parser.parse_args()
+
+    baseline = time_import(BASELINE, args.repeat)
+    print("{:<16} {:>8.1f} ms".format(BASELINE, baseline))
+    failed = False
+    for module in MODULES:
+        try:
+            elapsed = time_import(module, args.repeat)
+            heavy = heavy_modules_loaded(module)
+        except subprocess.CalledProcessError as e:
+            print("{:<16} import failed: {}".format(module, e.stderr.strip().splitlines()[-1]))
+            failed = True
+            continue
+        status = 'OK' if elapsed < args.budget_ms and not heavy else 'SLOW'
+        failed = failed or status != 'OK'
+        print("{:<16} {:>8.1f} ms  {}  {}".format(module, elapsed, status, ' '.join(heavy)))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,219 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from dtype_policy import DEFAULT_POLICY
+from utils import convert_to_serializable
+
+
+def _json_default(value):
+    # numpy scalars (np.int64, np.float32, ...) and other leftovers of pyradiomics outputs
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+def _atomic_save_npy(path, array):
+    tmp = path.with_name(path.stem + '.tmp.npy')
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+class VolumeCache:
+    """
+    Per-patient HU volumes stored as .npy in ``policy.storage_dtype`` (int16 by default).
+
+    Volumes are loaded memory-mapped, so several processes reading the same patient
+    share the pages instead of each decoding the DICOM series again.
+    """
+
+    def __init__(self, cache_dir="data/cache/volume", policy=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.policy = policy or DEFAULT_POLICY
+
+    def path(self, pid):
+        return self.cache_dir / "{}.npy".format(pid)
+
+    def __contains__(self, pid):
+        return self.path(pid).exists()
+
+    def load(self, pid, mmap_mode='r'):
+        return np.load(self.path(pid), mmap_mode=mmap_mode)
+
+    def save(self, pid, vol):
+        _atomic_save_npy(self.path(pid), self.policy.to_storage(vol))
+
+    def get(self, pid, compute, mmap_mode='r'):
+        """Return the cached volume of ``pid``, calling ``compute()`` (e.g. scan.to_volume) on a miss."""
+        if pid not in self:
+            self.save(pid, compute())
+        return self.load(pid, mmap_mode)
+
+
+class MaskCache:
+    """
+    Consensus nodule masks stored per (patient, nodule) as npz with the mask and its bbox.
+
+    ``tag`` should describe the consensus settings (confidence level, padding) so that
+    masks computed with different settings never collide.
+    """
+
+    def __init__(self, cache_dir="data/cache/mask", tag=''):
+        self.cache_dir = Path(cache_dir) / tag if tag else Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, pid, nodule_idx):
+        return self.cache_dir / "{}_{:03d}.npz".format(pid, nodule_idx)
+
+    def get(self, pid, nodule_idx, compute):
+        """
+        Return ``(mask, cbbox)`` for a nodule. ``compute()`` must return the same pair
+        (e.g. the first two values of pylidc.utils.consensus).
+        """
+        path = self.path(pid, nodule_idx)
+        if path.exists():
+            with np.load(path) as data:
+                bbox = tuple(slice(int(start), int(stop)) for start, stop in data['bbox'])
+                return data['mask'], bbox
+        mask, cbbox = compute()
+        bbox = np.array([[s.start, s.stop] for s in cbbox], dtype=np.int64)
+        tmp = path.with_name(path.stem + '.tmp.npz')
+        np.savez_compressed(tmp, mask=mask, bbox=bbox)
+        os.replace(tmp, path)
+        return mask, cbbox
+
+
+class FeatureCache:
+    """Per-nodule feature dictionaries stored as JSON, keyed by patient, nodule and a settings tag."""
+
+    def __init__(self, cache_dir="data/cache/features", tag=''):
+        self.cache_dir = Path(cache_dir) / tag if tag else Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, pid, nodule_idx):
+        return self.cache_dir / "{}_{:03d}.json".format(pid, nodule_idx)
+
+    def load(self, pid, nodule_idx):
+        """Cached features or None."""
+        path = self.path(pid, nodule_idx)
+        if not path.exists():
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def save(self, pid, nodule_idx, features):
+        features = convert_to_serializable(features)
+        path = self.path(pid, nodule_idx)
+        tmp = path.with_name(path.stem + '.tmp.json')
+        with open(tmp, 'w') as f:
+            json.dump(features, f, default=_json_default)
+        os.replace(tmp, path)
+        return features
+
+    def get(self, pid, nodule_idx, compute):
+        features = self.load(pid, nodule_idx)
+        if features is None:
+            features = self.save(pid, nodule_idx, compute())
+        return features
+
+
+def extractor_params(extractor):
+    """Settings, enabled image types and enabled features of a RadiomicsFeatureExtractor, as a canonical string."""
+    params = {
+        'settings': getattr(extractor, 'settings', {}),
+        'image_types': getattr(extractor, 'enabledImagetypes', {}),
+        'features': getattr(extractor, 'enabledFeatures', {}),
+    }
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+def radiomics_key(scan_array, mask_array, spacing, params):
+    """Content hash of one extract_radiomics call (image bytes, mask bytes, spacing, extractor params)."""
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=20)
+    for array in (np.ascontiguousarray(scan_array), np.ascontiguousarray(mask_array, dtype=np.uint8)):
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(array.data)
+    digest.update(repr(tuple(spacing) if spacing is not None else None).encode())
+    digest.update(params.encode())
+    return digest.hexdigest()
+
+
+class RadiomicsCache:
+    """
+    Persistent memoization of extract_radiomics results (SQLite), keyed by radiomics_key.
+
+    The cache is bounded to ``max_bytes`` of stored results: the least recently used entries are
+    evicted first. Cached features come back JSON-decoded (numpy values become floats / lists, as
+    with convert_to_serializable). Hit/miss counters are kept per instance, see ``stats``.
+    """
+
+    def __init__(self, path="data/cache/radiomics.sqlite", max_bytes=1024 ** 3):
+        import sqlite3
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Several worker processes may share the file: wait on locks instead of failing
+        self.connection = sqlite3.connect(str(self.path), timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS features '
+                                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS features_last_access ON features (last_access)')
+        self.connection.commit()
+
+    def get(self, key):
+        """Cached features of ``key`` or None."""
+        row = self.connection.execute('SELECT value FROM features WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.connection:
+            self.connection.execute('UPDATE features SET last_access = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, features):
+        """Store ``features`` under ``key``. Returns them decoded, exactly as ``get`` will."""
+        value = json.dumps(convert_to_serializable(dict(features)), default=_json_default)
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?)',
+                                    (key, value, len(value), time.time()))
+        self.evict()
+        return json.loads(value)
+
+    def size(self):
+        return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+
+    def evict(self):
+        """Remove least recently used entries until the stored size fits in max_bytes."""
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in self.connection.execute('SELECT key, size FROM features ORDER BY last_access'):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        with self.connection:
+            self.connection.executemany('DELETE FROM features WHERE key = ?', keys)
+        self.evictions += len(keys)
+
+    def stats(self):
+        entries = self.connection.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions, 'entries': entries, 'bytes': self.size()}
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM features')
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,153 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from cache import VolumeCache
+from dtype_policy import DEFAULT_POLICY
+from slice_index import META_COLUMNS
+from utils import segment_lung
+
+CLEAN_PATIENTS_FILE = 'clean_patients.csv'
+SAMPLING_MODES = ('uniform', 'stratified', 'first')
+
+
+def clean_slice_names(pid, z):
+    """CN= CleanNodule, CM = CleanMask (same names as the materialized clean dataset)."""
+    nodule_name = "{}/{}_CN001_slice{}".format(pid, pid[-4:], str(z).zfill(3))
+    mask_name = "{}/{}_CM001_slice{}".format(pid, pid[-4:], str(z).zfill(3))
+    return nodule_name, mask_name
+
+
+def parse_clean_name(name):
+    """Inverse of clean_slice_names: 'LIDC-IDRI-XXXX/XXXX_CN001_sliceZZZ' -> (pid, z)."""
+    pid, file_name = str(name).split('/')
+    return pid, int(file_name.rsplit('_slice', 1)[1])
+
+
+class CleanSliceSampler:
+    """
+    Virtual negative set: nodule-free slices drawn on demand from cached volumes.
+
+    Instead of writing the first 51 slices of every clean patient to disk, ``sample``
+    returns meta_info.csv rows (same columns and names as before) for slices drawn from
+    the lung-bearing part of each volume, and ``load`` segments a slice lazily, keeping
+    the most recent ones in an LRU cache. Calling ``sample`` with another epoch draws a
+    new, reproducible negative set. ``load`` can be called from several threads (e.g. the
+    augmentation prefetch threads of augment.py).
+
+    Sampling modes:
+    - 'uniform': slices drawn uniformly over the lung-bearing z range.
+    - 'stratified': the lung-bearing z range is split in ``n_per_patient`` bins, one slice per bin.
+    - 'first': the first ``n_per_patient`` slices of the volume (previous behaviour).
+    """
+
+    def __init__(self, pids, volume_cache=None, mode='uniform', n_per_patient=51, seed=42,
+                 lung_fraction=0.1, policy=None, cache_size=256):
+        if mode not in SAMPLING_MODES:
+            raise ValueError("mode must be one of {}".format(SAMPLING_MODES))
+        self.pids = list(pids)
+        self.policy = policy or DEFAULT_POLICY
+        self.volumes = volume_cache or VolumeCache(policy=self.policy)
+        self.mode = mode
+        self.n_per_patient = n_per_patient
+        self.seed = seed
+        self.lung_fraction = lung_fraction
+        self.cache_size = cache_size
+        self._segmented = OrderedDict()
+        self._lung_z = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to worker processes: locks cannot be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_meta(cls, meta_path, **kwargs):
+        """Build the sampler from the clean patient list written by MakeDataSet."""
+        import pandas as pd
+
+        pids = pd.read_csv(Path(meta_path) / CLEAN_PATIENTS_FILE)['patient_id'].tolist()
+        return cls(pids, **kwargs)
+
+    def volume(self, pid):
+        """Cached HU volume of ``pid`` (memory-mapped). Falls back to pylidc on a cache miss."""
+        def load_scan_volume():
+            from Nodule import LIDCBase
+            return LIDCBase(pid).query_scan().to_volume()
+        return self.volumes.get(pid, load_scan_volume)
+
+    def lung_slices(self, pid):
+        """
+        z indices of the slices that contain lung: slices where at least ``lung_fraction`` of the
+        central 300x300 window (the window used by segment_lung) is in the lung HU range.
+        """
+        if pid not in self._lung_z:
+            vol = self.volume(pid)
+            middle = vol[100:400, 100:400, :]
+            lung = np.mean((middle > -1000) & (middle < -400), axis=(0, 1))
+            z = np.flatnonzero(lung >= self.lung_fraction)
+            self._lung_z[pid] = z if len(z) else np.arange(vol.shape[2])
+        return self._lung_z[pid]
+
+    def _draw(self, pid, rng):
+        if self.mode == 'first':
+            return np.arange(min(self.n_per_patient, self.volume(pid).shape[2]))
+        z = self.lung_slices(pid)
+        n = min(self.n_per_patient, len(z))
+        if self.mode == 'uniform':
+            return np.sort(rng.choice(z, size=n, replace=False))
+        # stratified: one slice per equally sized bin of the lung range
+        bins = np.array_split(z, n)
+        return np.array([rng.choice(b) for b in bins])
+
+    def sample(self, epoch=0):
+        """
+        Draw the negative set of an epoch.
+
+        Returns:
+        - DataFrame: meta_info.csv rows (is_clean and is_virtual True) of the drawn slices.
+        """
+        import pandas as pd
+
+        rows = []
+        for patient_idx, pid in enumerate(self.pids):
+            # One stream per (seed, epoch, patient): adding patients does not change the others' draws
+            rng = np.random.default_rng([self.seed, epoch, patient_idx])
+            for z in self._draw(pid, rng):
+                nodule_name, mask_name = clean_slice_names(pid, int(z))
+                rows.append([pid[-4:], int(z), str(int(z)).zfill(3), nodule_name, mask_name, 0, False, True, True])
+        return pd.DataFrame(rows, columns=META_COLUMNS)
+
+    def load(self, name):
+        """
+        Segmented image and (empty) mask of a virtual clean slice.
+
+        Parameters:
+        - name: 'original_image' value of a row returned by ``sample``.
+
+        Returns:
+        - tuple: (segmented image, all-False mask).
+        """
+        pid, z = parse_clean_name(name)
+        key = (pid, z)
+        with self._lock:
+            image = self._segmented.get(key)
+            if image is not None:
+                self._segmented.move_to_end(key)
+        if image is None:
+            # Segmented outside the lock: other threads keep loading meanwhile
+            image = segment_lung(self.volume(pid)[:, :, z], self.policy)
+            image[image == -0] = 0
+            with self._lock:
+                self._segmented[key] = image
+                if len(self._segmented) > self.cache_size:
+                    self._segmented.popitem(last=False)
+        return image, np.zeros(image.shape, dtype=bool)
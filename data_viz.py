@@ -1,9 +1,10 @@
-import pylidc as pl
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sns
+
+# pylidc, matplotlib, seaborn and pandas are imported inside each function (slow imports)
 
 def plot_all_patients_annotations(plot=False):
+    import pylidc as pl
+    from Nodule import eager_scan_query
     # Initialize lists to collect annotation properties across all patients
     sphericities = []
     volumes = []
@@ -18,8 +19,8 @@ def plot_all_patients_annotations(plot=False):
     diameters = []
     lobulations = []
 
-    # Query all scans in the dataset
-    scans = pl.query(pl.Scan)
+    # Query all scans in the dataset (annotations and contours loaded in the same few queries)
+    scans = eager_scan_query(pl.query(pl.Scan))
 
     # Iterate over all scans in the dataset
     for scan in scans:
@@ -42,6 +43,7 @@ def plot_all_patients_annotations(plot=False):
     
     # If the 'plot' flag is True, generate the plots
     if plot:
+        import matplotlib.pyplot as plt
 
         # Create subplots for the histograms
         fig, axs = plt.subplots(6, 2, figsize=(12, 24))
@@ -141,6 +143,7 @@ def plot_all_patients_annotations(plot=False):
 
 
 def plot_CT(data,cmap = 'gray') : 
+    import matplotlib.pyplot as plt
     
     if data.ndim != 2:  # Si el arreglo no es 2D
         raise ValueError("Array must be 2d")
@@ -150,7 +153,61 @@ def plot_CT(data,cmap = 'gray') :
     plt.show()
     
 
+def plot_CT_preview(store, pid, z=None, level=1, zoom=False, cmap='gray'):
+    """
+    Axial slice from the preview pyramid (preview.PreviewStore) with the nodule centroids of that slice.
+    The full resolution slice is only read when ``zoom`` is True.
+    """
+    import matplotlib.pyplot as plt
+
+    preview = store.get(pid)
+    centroids = preview['centroids']
+    if z is None:
+        # First nodule slice, or the middle of the scan for clean patients
+        z = int(round(centroids[0, 2])) if len(centroids) else int(preview['shape'][2] // 2)
+    level = 0 if zoom else level
+    data = store.slice(pid, z, level)
+    scale = 2 ** level
+
+    plt.imshow(data, cmap=cmap)
+    near = centroids[np.abs(centroids[:, 2] - z) <= 1] if len(centroids) else centroids
+    if len(near):
+        plt.scatter(near[:, 1] / scale, near[:, 0] / scale, s=200, facecolors='none', edgecolors='red')
+    plt.title("{} slice {}".format(pid, z))
+    plt.axis('off')  # Oculta los ejes
+    plt.show()
+
+
+def plot_MIP_preview(store, pid, cmap='gray'):
+    """Axial and coronal maximum intensity projections of a scan with every nodule centroid."""
+    import matplotlib.pyplot as plt
+
+    preview = store.get(pid)
+    centroids = preview['centroids']
+
+    plt.figure(figsize=(12, 6))
+    plt.subplot(1, 2, 1)
+    plt.imshow(preview['mip_axial'], cmap=cmap)
+    if len(centroids):
+        plt.scatter(centroids[:, 1], centroids[:, 0], s=200, facecolors='none', edgecolors='red')
+    plt.title('Axial MIP')
+    plt.axis('off')
+
+    plt.subplot(1, 2, 2)
+    plt.imshow(preview['mip_coronal'], cmap=cmap, aspect='auto')
+    if len(centroids):
+        plt.scatter(centroids[:, 1], centroids[:, 2], s=200, facecolors='none', edgecolors='red')
+    plt.title('Coronal MIP')
+    plt.axis('off')
+
+    plt.suptitle("{}: {} nodules".format(pid, len(centroids)), fontsize=16)
+    plt.tight_layout()
+    plt.show()
+
+
 def pre_post_HU(data_pre, data_post):
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(12, 6))
         
     # Plot before HU processing
@@ -171,6 +228,9 @@ def pre_post_HU(data_pre, data_post):
 
 
 def plot_malignancies(malignancies_array) : 
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     # Set the style of the plot
     sns.set(style="whitegrid")
 
@@ -188,6 +248,8 @@ def plot_malignancies(malignancies_array) :
     
 
 def plot_malignancy_array_lenght(df) :
+    import matplotlib.pyplot as plt
+
     # Calcular las longitudes de las listas en la columna 'annotations'
     lengths = df['annotations'].apply(len)
 
@@ -216,6 +278,10 @@ def plot_malignancy_array_lenght(df) :
 
 
 def plot_co_ocurrency_matrix(data) : 
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+
     lista_anotaciones = [item[2] for item in data]
     valores = [1, 2, 3, 4, 5]
 
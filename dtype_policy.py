@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class DtypePolicy:
+    """
+    Dtype policy shared by the whole preprocessing pipeline.
+
+    HU volumes are stored as ``storage_dtype`` (int16 by default, enough for
+    the original 12-bit data) and every floating point operation runs in
+    ``compute_dtype`` (float32 by default). The HU window used for normalization
+    is kept on the policy so it can be persisted next to the data.
+
+    The nodule / clean slices written by MakeDataSet are not HU: they are the
+    segment_lung outputs (standardized, median filtered, diffused) the models are
+    trained on, so they are stored in ``compute_dtype``. Only their standardization
+    mean/std go to dtype_policy.json, which gives an approximation of the HU values
+    inside the lung; the exact HU of a slice come from the int16 volume (VolumeCache)
+    at the z / crop origin recorded in slice_index.csv. Volumes come from pylidc's
+    ``to_volume``, which applies the rescale slope/intercept itself, so they are not
+    persisted; ``convert_to_HU(..., return_rescale=True)`` returns them for callers
+    reading DICOM files directly.
+
+    ``LEGACY_POLICY`` (float64 storage and compute) reproduces the float64
+    outputs of the original pipeline exactly.
+    """
+
+    def __init__(self, storage_dtype='int16', compute_dtype='float32', min_hu=-1000, max_hu=400):
+        self.storage_dtype = np.dtype(storage_dtype)
+        self.compute_dtype = np.dtype(compute_dtype)
+        self.min_hu = min_hu
+        self.max_hu = max_hu
+
+    def __repr__(self):
+        return "DtypePolicy(storage_dtype='{}', compute_dtype='{}', min_hu={}, max_hu={})".format(
+            self.storage_dtype, self.compute_dtype, self.min_hu, self.max_hu)
+
+    def to_compute(self, array):
+        """Return ``array`` as ``compute_dtype`` (no copy if it already is)."""
+        return np.asarray(array).astype(self.compute_dtype, copy=False)
+
+    def to_storage(self, hu_image):
+        """
+        Cast a HU image to ``storage_dtype``.
+
+        For integer storage the values are rounded and clipped to the dtype range,
+        so integer slope/intercept (the LIDC case) round-trip without loss.
+        """
+        hu_image = np.asarray(hu_image)
+        if np.issubdtype(self.storage_dtype, np.integer):
+            if np.issubdtype(hu_image.dtype, np.integer) and np.can_cast(hu_image.dtype, self.storage_dtype):
+                return hu_image.astype(self.storage_dtype, copy=False)
+            info = np.iinfo(self.storage_dtype)
+            hu_image = np.clip(np.rint(hu_image), info.min, info.max)
+        return hu_image.astype(self.storage_dtype, copy=False)
+
+    def rescale(self, pixel_array, slope=1, intercept=0):
+        """
+        Apply ``HU = PixelValue * slope + intercept`` and return it in ``storage_dtype``.
+        """
+        if slope == 1 and np.issubdtype(self.storage_dtype, np.integer) and float(intercept).is_integer():
+            # Pure integer offset: stay in integers, no float temporaries
+            return self.to_storage(pixel_array.astype(np.int32) + int(intercept))
+        hu_image = self.to_compute(pixel_array) * self.compute_dtype.type(slope) + self.compute_dtype.type(intercept)
+        return self.to_storage(hu_image)
+
+    def to_dict(self):
+        """Serializable description of the policy (stored next to the generated data)."""
+        return {
+            'storage_dtype': self.storage_dtype.name,
+            'compute_dtype': self.compute_dtype.name,
+            'min_hu': self.min_hu,
+            'max_hu': self.max_hu,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    @classmethod
+    def from_config(cls, parser, section='dtype'):
+        """
+        Build the policy from a ConfigParser. Missing section/options fall back to the defaults,
+        ``legacy = True`` selects ``LEGACY_POLICY``.
+        """
+        if not parser.has_section(section):
+            return cls()
+        if parser.getboolean(section, 'legacy', fallback=False):
+            return cls('float64', 'float64')
+        return cls(parser.get(section, 'storage_dtype', fallback='int16'),
+                   parser.get(section, 'compute_dtype', fallback='float32'),
+                   parser.getint(section, 'min_hu', fallback=-1000),
+                   parser.getint(section, 'max_hu', fallback=400))
+
+
+DEFAULT_POLICY = DtypePolicy()
+LEGACY_POLICY = DtypePolicy('float64', 'float64')
@@ -0,0 +1,234 @@
+import argparse
+import numpy as np
+
+from utils import iter_json_items
+
+# Only the 'original' numeric features are used, as in utils.get_features_list
+FEATURE_PREFIX = 'original'
+ID_COLUMNS = ['Patient', 'Nodule', 'Slice']
+
+
+def iter_feature_records(json_path):
+    """
+    Stream the radiomics JSON (patient -> nodule -> slice -> features) one slice at a time.
+
+    Parameters:
+    - json_path (str): Ruta al archivo JSON generado con extract_radiomics.
+
+    Yields:
+    - tuple: (patient, nodule, slice, dict with the numeric 'original' features of the slice).
+    """
+    for paciente, nodulos in iter_json_items(json_path):
+        for nodulo, cts in nodulos.items():
+            for ct, caracteristicas in cts.items():
+                features = {key: value for key, value in caracteristicas.items()
+                            if key.startswith(FEATURE_PREFIX) and isinstance(value, (int, float))}
+                yield paciente, nodulo, ct, features
+
+
+def scan_feature_names(json_path):
+    """Streaming equivalent of utils.get_features_list. Returns the sorted feature names and the number of rows."""
+    features_list = set()
+    n_rows = 0
+    for _, _, _, features in iter_feature_records(json_path):
+        features_list.update(features)
+        n_rows += 1
+    return sorted(features_list), n_rows
+
+
+def iter_feature_chunks(json_path, feature_list, chunk_size=1024):
+    """
+    Stream the feature rows as dense float64 chunks. Missing features are NaN.
+
+    Yields:
+    - tuple: (list of (patient, nodule, slice) ids, numpy array of shape (rows, len(feature_list))).
+    """
+    column = {name: idx for idx, name in enumerate(feature_list)}
+    ids = []
+    chunk = np.full((chunk_size, len(feature_list)), np.nan)
+    for paciente, nodulo, ct, features in iter_feature_records(json_path):
+        row = len(ids)
+        for key, value in features.items():
+            if key in column:
+                chunk[row, column[key]] = value
+        ids.append((paciente, nodulo, ct))
+        if len(ids) == chunk_size:
+            yield ids, chunk
+            ids = []
+            chunk = np.full((chunk_size, len(feature_list)), np.nan)
+    if ids:
+        yield ids, chunk[:len(ids)]
+
+
+def _min_rows_chunks(chunks, min_rows):
+    """Merge the last chunk into the previous one when it is smaller than ``min_rows`` (IncrementalPCA needs it)."""
+    previous = None
+    for ids, chunk in chunks:
+        if previous is not None:
+            if len(ids) < min_rows:
+                ids, chunk = previous[0] + ids, np.vstack([previous[1], chunk])
+            else:
+                yield previous
+        previous = (ids, chunk)
+    if previous is not None:
+        yield previous
+
+
+class StreamingPCA:
+    """
+    Standardization + IncrementalPCA fitted over the radiomics JSON in chunks.
+
+    The full feature matrix is never built: every pass streams the JSON with
+    ``iter_feature_chunks`` and only ``chunk_size`` rows are in memory at a time.
+    Missing values are imputed with the feature mean (0 after standardization).
+    """
+
+    def __init__(self, n_components=None, chunk_size=1024):
+        self.n_components = n_components
+        self.chunk_size = chunk_size
+        self.feature_names = None
+        self.n_samples = 0
+        self.scale_mean = None
+        self.scale_std = None
+        self.pca_mean = None
+        self.components = None
+        self.explained_variance = None
+        self.explained_variance_ratio = None
+
+    def _standardize(self, chunk):
+        scaled = (chunk - self.scale_mean) / self.scale_std
+        scaled[np.isnan(scaled)] = 0
+        return scaled
+
+    def fit(self, json_path, feature_list=None):
+        """
+        Fit the scaler (first pass) and the incremental PCA (second pass) over the JSON.
+
+        Parameters:
+        - json_path (str): Ruta al archivo JSON.
+        - feature_list (list, optional): Features to use. By default all 'original' numeric features.
+        """
+        from sklearn.decomposition import IncrementalPCA
+        from sklearn.preprocessing import StandardScaler
+
+        if feature_list is None:
+            feature_list, _ = scan_feature_names(json_path)
+        self.feature_names = list(feature_list)
+        min_rows = self.n_components or len(self.feature_names)
+        if self.chunk_size < min_rows:
+            raise ValueError("chunk_size ({}) must be >= the number of components ({})".format(self.chunk_size, min_rows))
+
+        # Pass 1: mean / std of every feature (NaNs are ignored by partial_fit)
+        scaler = StandardScaler()
+        self.n_samples = 0
+        for ids, chunk in iter_feature_chunks(json_path, self.feature_names, self.chunk_size):
+            scaler.partial_fit(chunk)
+            self.n_samples += len(ids)
+        if self.n_samples < min_rows:
+            raise ValueError("{} has {} rows, at least {} (the number of components) are needed".format(
+                json_path, self.n_samples, min_rows))
+        self.scale_mean = scaler.mean_
+        self.scale_std = scaler.scale_
+        # Features that were never present have no mean: impute them as 0
+        self.scale_mean = np.nan_to_num(self.scale_mean)
+        self.scale_std = np.where(np.isnan(self.scale_std), 1.0, self.scale_std)
+
+        # Pass 2: incremental PCA on the standardized chunks
+        ipca = IncrementalPCA(n_components=self.n_components)
+        chunks = iter_feature_chunks(json_path, self.feature_names, self.chunk_size)
+        for _, chunk in _min_rows_chunks(chunks, min_rows):
+            ipca.partial_fit(self._standardize(chunk))
+
+        self.pca_mean = ipca.mean_
+        self.components = ipca.components_
+        self.explained_variance = ipca.explained_variance_
+        self.explained_variance_ratio = ipca.explained_variance_ratio_
+        return self
+
+    def transform(self, chunk):
+        """Project a (rows, features) chunk onto the principal components."""
+        return (self._standardize(chunk) - self.pca_mean) @ self.components.T
+
+    def transform_to_csv(self, json_path, output_csv):
+        """
+        Stream the JSON, project every slice and append the reduced rows to ``output_csv``.
+
+        Columns: Patient, Nodule, Slice, PC1..PCk.
+        """
+        import pandas as pd
+
+        columns = ["PC{}".format(i + 1) for i in range(self.components.shape[0])]
+        header = True
+        for ids, chunk in iter_feature_chunks(json_path, self.feature_names, self.chunk_size):
+            reduced = pd.DataFrame(self.transform(chunk), columns=columns)
+            reduced = pd.concat([pd.DataFrame(ids, columns=ID_COLUMNS), reduced], axis=1)
+            reduced.to_csv(output_csv, mode='w' if header else 'a', header=header, index=False)
+            header = False
+
+    def cumulative_explained_variance(self):
+        """Cumulative explained variance ratio per number of components."""
+        return np.cumsum(self.explained_variance_ratio)
+
+    def save(self, path):
+        """Persist the fitted scaler and components (npz)."""
+        np.savez(path,
+                 feature_names=np.array(self.feature_names),
+                 n_samples=self.n_samples,
+                 chunk_size=self.chunk_size,
+                 scale_mean=self.scale_mean,
+                 scale_std=self.scale_std,
+                 pca_mean=self.pca_mean,
+                 components=self.components,
+                 explained_variance=self.explained_variance,
+                 explained_variance_ratio=self.explained_variance_ratio)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        model = cls(n_components=data['components'].shape[0], chunk_size=int(data['chunk_size']))
+        model.feature_names = data['feature_names'].tolist()
+        model.n_samples = int(data['n_samples'])
+        model.scale_mean = data['scale_mean']
+        model.scale_std = data['scale_std']
+        model.pca_mean = data['pca_mean']
+        model.components = data['components']
+        model.explained_variance = data['explained_variance']
+        model.explained_variance_ratio = data['explained_variance_ratio']
+        return model
+
+    def plot_cumulative_variance(self, output_path=None):
+        """Cumulative explained variance plot (same figure as images/cumvar_pca.png)."""
+        import matplotlib.pyplot as plt
+
+        cumulative = self.cumulative_explained_variance()
+        plt.figure(figsize=(10, 6))
+        plt.plot(range(1, len(cumulative) + 1), cumulative, marker='o', linestyle='--')
+        plt.title('Cumulative Explained Variance by PCA Components')
+        plt.xlabel('Number of Components')
+        plt.ylabel('Cumulative Explained Variance')
+        plt.grid(True)
+        if output_path:
+            plt.savefig(output_path)
+        else:
+            plt.show()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Streaming standardization + incremental PCA over the radiomics JSON')
+    arg_parser.add_argument('json_path', help='Radiomics JSON (patient -> nodule -> slice -> features)')
+    arg_parser.add_argument('--output', default='pca_features.csv', help='Reduced table (csv)')
+    arg_parser.add_argument('--model', default='pca_model.npz', help='Where to store the fitted components')
+    arg_parser.add_argument('--n-components', type=int, default=None)
+    arg_parser.add_argument('--chunk-size', type=int, default=1024)
+    arg_parser.add_argument('--plot', default=None, help='Save the cumulative explained variance plot to this path')
+    args = arg_parser.parse_args()
+
+    pca = StreamingPCA(args.n_components, args.chunk_size).fit(args.json_path)
+    pca.save(args.model)
+    pca.transform_to_csv(args.json_path, args.output)
+
+    print("Fitted on {} slices, {} features".format(pca.n_samples, len(pca.feature_names)))
+    for idx, value in enumerate(pca.cumulative_explained_variance()):
+        print("PC{:<4} {:.4f}".format(idx + 1, value))
+    if args.plot:
+        pca.plot_cumulative_variance(args.plot)
@@ -3,6 +3,11 @@ import numpy as np
 # Read DICOM file
 from pathlib import Path
 
+from dtype_policy import DEFAULT_POLICY
+
+# int16 HU storage, float32 compute (use LEGACY_POLICY for the old float64 output)
+policy = DEFAULT_POLICY
+
 # Define the directory of the LIDC-IRDI files. For now we will work with just one pacient
 directory = Path(".LIDC-IDRI/LIDC-IDRI-0001")
 
@@ -16,11 +21,11 @@ for archive in directory.rglob('*'):
         intercept = dicom_file.RescaleIntercept if 'RescaleIntercept' in dicom_file else 0
         slope = dicom_file.RescaleSlope if 'RescaleSlope' in dicom_file else 1
 
-        # Aplicar la conversión a unidades Hounsfield
-        hu_image = image_array * slope + intercept
+        # Aplicar la conversión a unidades Hounsfield (int16)
+        hu_image = policy.rescale(image_array, float(slope), float(intercept))
 
         # Limitar los valores HU a un rango común
-        def clip_hu_range(hu_image, min_hu=-1000, max_hu=400):
+        def clip_hu_range(hu_image, min_hu=policy.min_hu, max_hu=policy.max_hu):
             hu_image = np.clip(hu_image, min_hu, max_hu)
             return hu_image
 
@@ -29,8 +34,8 @@ for archive in directory.rglob('*'):
 
 
         # Normalize values between 0 y 1
-        def normalize_hu(hu_image, min_hu=-1000, max_hu=400):
-            hu_image = (hu_image - min_hu) / (max_hu - min_hu)
+        def normalize_hu(hu_image, min_hu=policy.min_hu, max_hu=policy.max_hu):
+            hu_image = (policy.to_compute(hu_image) - min_hu) / (max_hu - min_hu)
             hu_image[hu_image > 1] = 1  # Limit maximum values to 1
             hu_image[hu_image < 0] = 0  # Limit minimum values to 0
             return hu_image
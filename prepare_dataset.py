@@ -2,20 +2,23 @@ import sys
 import os
 from pathlib import Path
 import glob
+import json
 from configparser import ConfigParser
-import pandas as pd
 import numpy as np
 import warnings
-import pylidc as pl
-from tqdm import tqdm
 from statistics import median_high
 
-from utils import is_dir_path,segment_lung
-from pylidc.utils import consensus
-from PIL import Image
+from utils import is_dir_path,segment_lung,DtypePolicy
+from slice_index import INDEX_COLUMNS,INDEX_FILE,META_COLUMNS,slice_stats,save_nodule_slice
+from clean_sampler import CLEAN_PATIENTS_FILE,CleanSliceSampler,clean_slice_names
+from cache import VolumeCache
+# pandas, pylidc and tqdm are imported where they are used so that spawning workers stays fast
 
 warnings.filterwarnings(action='ignore')
 
+# This is to name each image and mask
+prefix = [str(x).zfill(3) for x in range(1000)]
+
 # Read the configuration file generated from config_file_create.py
 parser = ConfigParser()
 parser.read('lung.conf')
@@ -30,13 +33,28 @@ META_DIR = is_dir_path(parser.get('prepare_dataset','META_PATH'))
 
 #Hyper Parameter setting for prepare dataset function
 mask_threshold = parser.getint('prepare_dataset','Mask_Threshold')
+#Clean (nodule-free) slices: 'materialize' = first 51 slices saved to disk, 'virtual' = sampled on demand from cached volumes
+clean_mode = parser.get('prepare_dataset','Clean_Mode',fallback='materialize')
+volume_cache_dir = parser.get('prepare_dataset','VOLUME_CACHE_PATH',fallback='data/cache/volume')
+#Virtual clean sampling (see clean_sampler.py): 'uniform', 'stratified' or 'first', slices per patient and seed
+clean_sampling = parser.get('prepare_dataset','Clean_Sampling',fallback='uniform')
+clean_per_patient = parser.getint('prepare_dataset','Clean_Per_Patient',fallback=51)
+clean_seed = parser.getint('prepare_dataset','Clean_Seed',fallback=42)
+
+#Parallel preprocessing: number of workers and RAM budget (GB) shared by them
+workers = parser.getint('scheduler','workers',fallback=1)
+memory_budget = int(parser.getfloat('scheduler','memory_budget_gb',fallback=8) * 1024**3)
 
 #Hyper Parameter setting for pylidc
 confidence_level = parser.getfloat('pylidc','confidence_level')
 padding = parser.getint('pylidc','padding_size')
 
+#Dtype policy: int16 HU storage / float32 compute unless [dtype] says otherwise
+dtype_policy = DtypePolicy.from_config(parser)
+
 class MakeDataSet:
-    def __init__(self, LIDC_Patients_list, IMAGE_DIR, MASK_DIR,CLEAN_DIR_IMAGE,CLEAN_DIR_MASK,META_DIR, mask_threshold, padding, confidence_level=0.5):
+    def __init__(self, LIDC_Patients_list, IMAGE_DIR, MASK_DIR,CLEAN_DIR_IMAGE,CLEAN_DIR_MASK,META_DIR, mask_threshold, padding, confidence_level=0.5, policy=None, clean_mode='materialize', volume_cache_dir='data/cache/volume',
+                 clean_sampling='uniform', clean_per_patient=51, clean_seed=42):
         self.IDRI_list = LIDC_Patients_list
         self.img_path = IMAGE_DIR
         self.mask_path = MASK_DIR
@@ -46,7 +64,20 @@ class MakeDataSet:
         self.mask_threshold = mask_threshold
         self.c_level = confidence_level
         self.padding = [(padding,padding),(padding,padding),(0,0)]
-        self.meta = pd.DataFrame(index=[],columns=['patient_id','nodule_no','slice_no','original_image','mask_image','malignancy','is_cancer','is_clean'])
+        # Constructor arguments, used to rebuild the dataset maker inside worker processes
+        self.settings = dict(LIDC_Patients_list=[], IMAGE_DIR=IMAGE_DIR, MASK_DIR=MASK_DIR, CLEAN_DIR_IMAGE=CLEAN_DIR_IMAGE,
+                             CLEAN_DIR_MASK=CLEAN_DIR_MASK, META_DIR=META_DIR, mask_threshold=mask_threshold, padding=padding,
+                             confidence_level=confidence_level, policy=policy, clean_mode=clean_mode, volume_cache_dir=volume_cache_dir,
+                             clean_sampling=clean_sampling, clean_per_patient=clean_per_patient, clean_seed=clean_seed)
+        self.policy = policy or DtypePolicy()
+        self.normalization = {}
+        self.clean_mode = clean_mode
+        self.clean_sampling = dict(mode=clean_sampling, n_per_patient=clean_per_patient, seed=clean_seed)
+        self.volume_cache = VolumeCache(volume_cache_dir,self.policy)
+        self.clean_patients = []
+        # Statistics of every consensus slice, admitted or not (see slice_index.py)
+        self.slice_index = []
+        self.meta_rows = []
 
 
     def calculate_malignancy(self,nodule):
@@ -66,13 +97,124 @@ class MakeDataSet:
         else:
             return malignancy, 'Ambiguous'
     def save_meta(self,meta_list):
-        """Saves the information of nodule to csv file"""
-        tmp = pd.Series(meta_list,index=['patient_id','nodule_no','slice_no','original_image','mask_image','malignancy','is_cancer','is_clean'])
-        self.meta = self.meta.append(tmp,ignore_index=True)
+        """Saves the information of nodule to csv file (written at the end of prepare_dataset)"""
+        self.meta_rows.append(meta_list)
+
+    def results(self):
+        """Everything recorded for the processed patients (returned by the worker processes)"""
+        return {'meta_rows':self.meta_rows,'normalization':self.normalization,
+                'slice_index':self.slice_index,'clean_patients':self.clean_patients}
+
+    def merge_results(self,results):
+        self.meta_rows.extend(results['meta_rows'])
+        self.normalization.update(results['normalization'])
+        self.slice_index.extend(results['slice_index'])
+        self.clean_patients.extend(results['clean_patients'])
+
+    def prepare_parallel(self, workers, memory_budget):
+        """Runs process_patient in worker processes, scheduled against the memory budget"""
+        from tqdm import tqdm
+        from Nodule import prefetch_scans
+        from scheduler import MemoryAwareScheduler, count_slices
+
+        # Slice counts come from the Scan rows of the pylidc database: no image is decoded and no
+        # annotation/contour is loaded here (the workers load them for their own patient)
+        scans = prefetch_scans(self.IDRI_list,eager=False)
+        for pid in self.IDRI_list:
+            if pid not in scans:
+                print("No scan found for patient ID {}".format(pid))
+        jobs = [(pid,count_slices(scans[pid])) for pid in self.IDRI_list if pid in scans]
+
+        results = {}
+        scheduler = MemoryAwareScheduler(memory_budget,workers)
+        for pid, result in tqdm(scheduler.run(jobs,_process_patient_job,(self.settings,)), total=len(jobs)):
+            results[pid] = result
+        # Merge in patient order so meta_info.csv does not depend on the completion order
+        for pid in self.IDRI_list:
+            if pid in results:
+                self.merge_results(results[pid])
+
+    def process_patient(self, pid, scan):
+        """Saves the nodule (or clean) slices of one patient and records their meta information"""
+        from pylidc.utils import consensus
+
+        IMAGE_DIR = Path(self.img_path)
+        MASK_DIR = Path(self.mask_path)
+        CLEAN_DIR_IMAGE = Path(self.clean_path_img)
+        CLEAN_DIR_MASK = Path(self.clean_path_mask)
+
+        nodules_annotation = scan.cluster_annotations()
+        vol = scan.to_volume()
+        print("Patient ID: {} Dicom Shape: {} Number of Annotated Nodules: {}".format(pid,vol.shape,len(nodules_annotation)))
+
+        patient_image_dir = IMAGE_DIR / pid
+        patient_mask_dir = MASK_DIR / pid
+        Path(patient_image_dir).mkdir(parents=True, exist_ok=True)
+        Path(patient_mask_dir).mkdir(parents=True, exist_ok=True)
 
-    def prepare_dataset(self):
-        # This is to name each image and mask
-        prefix = [str(x).zfill(3) for x in range(1000)]
+        if len(nodules_annotation) > 0:
+            # Patients with nodules
+            for nodule_idx, nodule in enumerate(nodules_annotation):
+            # Call nodule images. Each Patient will have at maximum 4 annotations as there are only 4 doctors
+            # This current for loop iterates over total number of nodules in a single patient
+                mask, cbbox, masks = consensus(nodule,self.c_level,self.padding)
+                lung_np_array = vol[cbbox]
+
+                # We calculate the malignancy information
+                malignancy, cancer_label = self.calculate_malignancy(nodule)
+
+                for nodule_slice in range(mask.shape[2]):
+                    # This second for loop iterates over each single nodule.
+                    # Every slice is recorded in the index so that another threshold can be applied later
+                    row = slice_stats(pid,nodule_idx,nodule_slice,mask[:,:,nodule_slice],lung_np_array[:,:,nodule_slice],cbbox,malignancy,cancer_label)
+                    self.slice_index.append(row)
+                    # There are some mask sizes that are too small. These may hinder training.
+                    if row[INDEX_COLUMNS.index('mask_pixels')] <= self.mask_threshold:
+                        continue
+                    # Segment Lung part only and save it
+                    # Naming of each file: NI= Nodule Image, MA= Mask Original
+                    nodule_name, mask_name, stats = save_nodule_slice(pid,nodule_idx,nodule_slice,lung_np_array[:,:,nodule_slice],mask[:,:,nodule_slice],patient_image_dir,patient_mask_dir,self.policy)
+                    meta_list = [pid[-4:],nodule_idx,prefix[nodule_slice],nodule_name,mask_name,malignancy,cancer_label,False,False]
+
+                    self.save_meta(meta_list)
+                    self.normalization[nodule_name] = stats
+        elif self.clean_mode == 'virtual':
+            print("Clean Dataset (virtual)",pid)
+            # Only the volume is kept: clean slices are drawn and segmented on demand by CleanSliceSampler
+            self.volume_cache.save(pid,vol)
+            self.clean_patients.append(pid)
+        else:
+            print("Clean Dataset",pid)
+            patient_clean_dir_image = CLEAN_DIR_IMAGE / pid
+            patient_clean_dir_mask = CLEAN_DIR_MASK / pid
+            Path(patient_clean_dir_image).mkdir(parents=True, exist_ok=True)
+            Path(patient_clean_dir_mask).mkdir(parents=True, exist_ok=True)
+            #There are patients that don't have nodule at all. Meaning, its a clean dataset. We need to use this for validation
+            for slice in range(vol.shape[2]):
+                if slice >50:
+                    break
+                lung_segmented_np_array, stats = segment_lung(vol[:,:,slice],self.policy,return_stats=True)
+                lung_segmented_np_array[lung_segmented_np_array==-0] =0
+                lung_mask = np.zeros(lung_segmented_np_array.shape,dtype=bool)
+
+                #CN= CleanNodule, CM = CleanMask
+                nodule_name, mask_name = clean_slice_names(pid,slice)
+                meta_list = [pid[-4:],slice,prefix[slice],nodule_name,mask_name,0,False,True,False]
+                self.save_meta(meta_list)
+                self.normalization[nodule_name] = stats
+                np.save(patient_clean_dir_image / nodule_name, lung_segmented_np_array)
+                np.save(patient_clean_dir_mask / mask_name, lung_mask)
+
+    def prepare_dataset(self, workers=1, memory_budget=None):
+        """
+        Process every patient and save meta_info.csv.
+
+        With ``workers`` > 1 the patients run in parallel processes, admitted against
+        ``memory_budget`` bytes by scheduler.MemoryAwareScheduler (biggest scans first).
+        Without ``memory_budget`` the scheduler uses 80% of the physical RAM.
+        """
+        from tqdm import tqdm
+        from Nodule import iter_scans
 
         # Make directory
         if not os.path.exists(self.img_path):
@@ -86,81 +228,49 @@ class MakeDataSet:
         if not os.path.exists(self.meta_path):
             os.makedirs(self.meta_path)
 
-        IMAGE_DIR = Path(self.img_path)
-        MASK_DIR = Path(self.mask_path)
-        CLEAN_DIR_IMAGE = Path(self.clean_path_img)
-        CLEAN_DIR_MASK = Path(self.clean_path_mask)
+        if workers > 1:
+            self.prepare_parallel(workers, memory_budget)
+        else:
+            # Scans, annotations and contours are prefetched in batches instead of one query per patient
+            for pid, scan in tqdm(iter_scans(self.IDRI_list), total=len(self.IDRI_list)):
+                #pid: LIDC-IDRI-0001~
+                if scan is None:
+                    print("No scan found for patient ID {}".format(pid))
+                    continue
+                self.process_patient(pid, scan)
 
+        import pandas as pd
+        self.meta = pd.DataFrame(self.meta_rows,columns=META_COLUMNS)
+        if self.clean_patients:
+            pd.DataFrame({'patient_id':self.clean_patients}).to_csv(os.path.join(self.meta_path,CLEAN_PATIENTS_FILE),index=False)
+            # Epoch 0 draw, marked is_virtual: no files on disk, images are loaded with CleanSliceSampler.load
+            sampler = CleanSliceSampler(self.clean_patients,self.volume_cache,policy=self.policy,**self.clean_sampling)
+            self.meta = pd.concat([self.meta,sampler.sample(epoch=0)],ignore_index=True)
 
+        print("Saved Meta data")
+        self.meta.to_csv(os.path.join(self.meta_path,'meta_info.csv'),index=False)
+        self.save_slice_index()
+        self.save_policy()
 
-        for patient in tqdm(self.IDRI_list):
-            pid = patient #LIDC-IDRI-0001~
-            scan = pl.query(pl.Scan).filter(pl.Scan.patient_id == pid).first()
-            nodules_annotation = scan.cluster_annotations()
-            vol = scan.to_volume()
-            print("Patient ID: {} Dicom Shape: {} Number of Annotated Nodules: {}".format(pid,vol.shape,len(nodules_annotation)))
-
-            patient_image_dir = IMAGE_DIR / pid
-            patient_mask_dir = MASK_DIR / pid
-            Path(patient_image_dir).mkdir(parents=True, exist_ok=True)
-            Path(patient_mask_dir).mkdir(parents=True, exist_ok=True)
-
-            if len(nodules_annotation) > 0:
-                # Patients with nodules
-                for nodule_idx, nodule in enumerate(nodules_annotation):
-                # Call nodule images. Each Patient will have at maximum 4 annotations as there are only 4 doctors
-                # This current for loop iterates over total number of nodules in a single patient
-                    mask, cbbox, masks = consensus(nodule,self.c_level,self.padding)
-                    lung_np_array = vol[cbbox]
-
-                    # We calculate the malignancy information
-                    malignancy, cancer_label = self.calculate_malignancy(nodule)
-
-                    for nodule_slice in range(mask.shape[2]):
-                        # This second for loop iterates over each single nodule.
-                        # There are some mask sizes that are too small. These may hinder training.
-                        if np.sum(mask[:,:,nodule_slice]) <= self.mask_threshold:
-                            continue
-                        # Segment Lung part only
-                        lung_segmented_np_array = segment_lung(lung_np_array[:,:,nodule_slice])
-                        # I am not sure why but some values are stored as -0. <- this may result in datatype error in pytorch training # Not sure
-                        lung_segmented_np_array[lung_segmented_np_array==-0] =0
-                        # This itereates through the slices of a single nodule
-                        # Naming of each file: NI= Nodule Image, MA= Mask Original
-                        nodule_name = "{}_NI{}_slice{}".format(pid[-4:],prefix[nodule_idx],prefix[nodule_slice])
-                        mask_name = "{}_MA{}_slice{}".format(pid[-4:],prefix[nodule_idx],prefix[nodule_slice])
-                        meta_list = [pid[-4:],nodule_idx,prefix[nodule_slice],nodule_name,mask_name,malignancy,cancer_label,False]
-
-                        self.save_meta(meta_list)
-                        np.save(patient_image_dir / nodule_name,lung_segmented_np_array)
-                        np.save(patient_mask_dir / mask_name,mask[:,:,nodule_slice])
-            else:
-                print("Clean Dataset",pid)
-                patient_clean_dir_image = CLEAN_DIR_IMAGE / pid
-                patient_clean_dir_mask = CLEAN_DIR_MASK / pid
-                Path(patient_clean_dir_image).mkdir(parents=True, exist_ok=True)
-                Path(patient_clean_dir_mask).mkdir(parents=True, exist_ok=True)
-                #There are patients that don't have nodule at all. Meaning, its a clean dataset. We need to use this for validation
-                for slice in range(vol.shape[2]):
-                    if slice >50:
-                        break
-                    lung_segmented_np_array = segment_lung(vol[:,:,slice])
-                    lung_segmented_np_array[lung_segmented_np_array==-0] =0
-                    lung_mask = np.zeros_like(lung_segmented_np_array)
-
-                    #CN= CleanNodule, CM = CleanMask
-                    nodule_name = "{}/{}_CN001_slice{}".format(pid,pid[-4:],prefix[slice])
-                    mask_name = "{}/{}_CM001_slice{}".format(pid,pid[-4:],prefix[slice])
-                    meta_list = [pid[-4:],slice,prefix[slice],nodule_name,mask_name,0,False,True]
-                    self.save_meta(meta_list)
-                    np.save(patient_clean_dir_image / nodule_name, lung_segmented_np_array)
-                    np.save(patient_clean_dir_mask / mask_name, lung_mask)
+    def save_slice_index(self):
+        """Saves the per-slice statistics used by slice_index.py to change the mask threshold"""
+        import pandas as pd
+        pd.DataFrame(self.slice_index,columns=INDEX_COLUMNS).to_csv(os.path.join(self.meta_path,INDEX_FILE),index=False)
 
+    def save_policy(self):
+        """Saves the dtype policy and the per-slice standardization parameters next to meta_info.csv"""
+        with open(os.path.join(self.meta_path,'dtype_policy.json'),'w') as f:
+            json.dump({'policy':self.policy.to_dict(),'normalization':self.normalization},f,indent=4)
 
 
-        print("Saved Meta data")
-        self.meta.to_csv(self.meta_path+'meta_info.csv',index=False)
+def _process_patient_job(settings, pid):
+    """Worker process entry point: process one patient and return what was recorded"""
+    from Nodule import prefetch_scans
 
+    dataset = MakeDataSet(**settings)
+    # Scan, annotations and contours in one go (eager_scan_query), not one query per contour
+    dataset.process_patient(pid, prefetch_scans([pid])[pid])
+    return dataset.results()
 
 
 if __name__ == '__main__':
@@ -169,5 +279,5 @@ if __name__ == '__main__':
     LIDC_IDRI_list.sort()
 
 
-    test= MakeDataSet(LIDC_IDRI_list,IMAGE_DIR,MASK_DIR,CLEAN_DIR_IMAGE,CLEAN_DIR_MASK,META_DIR,mask_threshold,padding,confidence_level)
-    test.prepare_dataset()
+    test= MakeDataSet(LIDC_IDRI_list,IMAGE_DIR,MASK_DIR,CLEAN_DIR_IMAGE,CLEAN_DIR_MASK,META_DIR,mask_threshold,padding,confidence_level,dtype_policy,clean_mode,volume_cache_dir,clean_sampling,clean_per_patient,clean_seed)
+    test.prepare_dataset(workers,memory_budget)
@@ -0,0 +1,160 @@
+import argparse
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from cache import VolumeCache
+from dtype_policy import DEFAULT_POLICY
+from utils import convert_to_HU
+
+# Display window of the previews (same default range as clip_hu_range)
+PREVIEW_MIN_HU = -1000
+PREVIEW_MAX_HU = 400
+
+
+def window_to_uint8(hu, min_hu=PREVIEW_MIN_HU, max_hu=PREVIEW_MAX_HU):
+    """Clip to [min_hu, max_hu] and scale to 0-255 (uint8)."""
+    scaled = (np.clip(hu, min_hu, max_hu).astype(np.float32) - min_hu) * (255.0 / (max_hu - min_hu))
+    return np.rint(scaled).astype(np.uint8)
+
+
+def downsample2(vol):
+    """2x2 block mean over the first two axes (rows, columns); odd edges are dropped."""
+    rows, cols = vol.shape[0] // 2 * 2, vol.shape[1] // 2 * 2
+    vol = vol[:rows, :cols].astype(np.float32)
+    return (vol[0::2, 0::2] + vol[1::2, 0::2] + vol[0::2, 1::2] + vol[1::2, 1::2]) / 4
+
+
+def nodule_centroids(nodules):
+    """Mean (row, col, slice) voxel centroid of every clustered nodule (scan.cluster_annotations())."""
+    return np.array([np.mean([ann.centroid for ann in nodule], axis=0) for nodule in nodules], dtype=np.float32).reshape(-1, 3)
+
+
+def build_preview(vol, nodules=(), levels=3, min_hu=PREVIEW_MIN_HU, max_hu=PREVIEW_MAX_HU, chunk=32):
+    """
+    Build the preview of one scan.
+
+    Parameters:
+    - vol: HU volume (rows, columns, slices), e.g. scan.to_volume() or VolumeCache.load.
+    - nodules: Output of scan.cluster_annotations(), used for the centroid overlays.
+    - levels: Number of pyramid levels; level l is downsampled by 2**l (level 0 is the volume itself).
+    - chunk: Slices processed at a time, bounds the float temporaries.
+
+    Returns:
+    - dict: 'level1'..'levelN' (uint8 pyramids), 'mip_axial', 'mip_coronal' (uint8), 'centroids', 'window', 'shape'.
+    """
+    preview = {}
+    pyramid = [[] for _ in range(levels)]
+    mip_axial = np.full(vol.shape[:2], np.iinfo(np.int16).min, dtype=np.float32)
+    mip_coronal = np.empty((vol.shape[1], vol.shape[2]), dtype=np.float32)
+    for start in range(0, vol.shape[2], chunk):
+        block = np.asarray(vol[:, :, start:start + chunk], dtype=np.float32)
+        np.maximum(mip_axial, block.max(axis=2), out=mip_axial)
+        mip_coronal[:, start:start + chunk] = block.max(axis=0)
+        for level in range(levels):
+            block = downsample2(block)
+            pyramid[level].append(window_to_uint8(block, min_hu, max_hu))
+    for level in range(levels):
+        preview['level{}'.format(level + 1)] = np.concatenate(pyramid[level], axis=2)
+    preview['mip_axial'] = window_to_uint8(mip_axial, min_hu, max_hu)
+    # Coronal MIP displayed as (slices, columns)
+    preview['mip_coronal'] = window_to_uint8(mip_coronal.T, min_hu, max_hu)
+    preview['centroids'] = nodule_centroids(nodules)
+    preview['window'] = np.array([min_hu, max_hu])
+    preview['shape'] = np.array(vol.shape)
+    return preview
+
+
+class PreviewStore:
+    """
+    Previews of the whole cohort, one compressed npz per patient (a few MB instead of the full volume).
+
+    Building a preview never writes the full volume anywhere: it reuses the VolumeCache entry
+    when there is one and otherwise decodes the scan in memory. ``get`` keeps the ``cache_size``
+    most recently used previews in memory, so browsing is limited by the display, not the disk.
+    ``slice`` returns a pyramid level, or the full resolution slice in HU when ``level`` is 0,
+    read on demand: from the VolumeCache (memory-mapped) or from that slice's DICOM file.
+    """
+
+    def __init__(self, preview_dir="data/cache/preview", volume_cache=None, levels=3, cache_size=32):
+        self.preview_dir = Path(preview_dir)
+        self.preview_dir.mkdir(parents=True, exist_ok=True)
+        self.volumes = volume_cache or VolumeCache(policy=DEFAULT_POLICY)
+        self.levels = levels
+        self.cache_size = cache_size
+        self._loaded = OrderedDict()
+
+    def path(self, pid):
+        return self.preview_dir / "{}.npz".format(pid)
+
+    def __contains__(self, pid):
+        return self.path(pid).exists()
+
+    def build(self, pid, scan=None, overwrite=False):
+        """Build and store the preview of ``pid`` (volume from the VolumeCache, nodules from pylidc)."""
+        if pid in self and not overwrite:
+            return self.path(pid)
+        if scan is None:
+            from Nodule import LIDCBase
+            scan = LIDCBase(pid).query_scan()
+        vol = self.volumes.load(pid) if pid in self.volumes else scan.to_volume()
+        preview = build_preview(vol, scan.cluster_annotations(), self.levels)
+        tmp = self.path(pid).with_name(pid + '.tmp.npz')
+        np.savez_compressed(tmp, **preview)
+        tmp.replace(self.path(pid))
+        self._loaded.pop(pid, None)
+        return self.path(pid)
+
+    def build_many(self, pids, overwrite=False):
+        """Build the previews of many patients, prefetching their scans and annotations in batches."""
+        from Nodule import iter_scans
+
+        for pid, scan in iter_scans(pids):
+            if scan is None:
+                print("No scan found for patient ID {}".format(pid))
+                continue
+            self.build(pid, scan, overwrite)
+
+    def get(self, pid):
+        """Preview dict of ``pid`` (built on first use)."""
+        if pid in self._loaded:
+            self._loaded.move_to_end(pid)
+            return self._loaded[pid]
+        if pid not in self:
+            self.build(pid)
+        with np.load(self.path(pid)) as data:
+            preview = {key: data[key] for key in data.files}
+        self._loaded[pid] = preview
+        if len(self._loaded) > self.cache_size:
+            self._loaded.popitem(last=False)
+        return preview
+
+    def slice(self, pid, z, level=1):
+        """Axial slice ``z`` at pyramid ``level`` (uint8), or in HU at full resolution when level is 0."""
+        if level == 0:
+            if pid in self.volumes:
+                return np.asarray(self.volumes.load(pid)[:, :, z])
+            return self._dicom_slice(pid, z)
+        return self.get(pid)['level{}'.format(level)][:, :, z]
+
+    def _dicom_slice(self, pid, z):
+        """Slice ``z`` of the scan (same order as scan.to_volume), decoded from its DICOM file only."""
+        from Nodule import LIDCBase
+
+        scan = LIDCBase(pid).query_scan()
+        file_name = scan.sorted_dicom_file_names.split(',')[z]
+        return convert_to_HU(Path(scan.get_path_to_dicom_files()) / file_name, self.volumes.policy)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Build the slice pyramid / MIP previews of a list of patients')
+    arg_parser.add_argument('patients', nargs='+', help='Patient IDs (LIDC-IDRI-XXXX)')
+    arg_parser.add_argument('--preview-dir', default='data/cache/preview')
+    arg_parser.add_argument('--volume-cache', default='data/cache/volume', help='Volumes already cached there are reused, none is written')
+    arg_parser.add_argument('--levels', type=int, default=3)
+    arg_parser.add_argument('--overwrite', action='store_true')
+    args = arg_parser.parse_args()
+
+    store = PreviewStore(args.preview_dir, VolumeCache(args.volume_cache), args.levels)
+    store.build_many(args.patients, args.overwrite)
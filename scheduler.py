@@ -0,0 +1,169 @@
+import json
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import numpy as np
+
+# Default cost model of one per-patient preprocessing job (refined from the recorded history):
+# interpreter + imports, and bytes per voxel at the peak (DICOM pixel arrays, to_volume output,
+# consensus crops and segment_lung temporaries).
+DEFAULT_BASE_BYTES = 600 * 1024 ** 2
+DEFAULT_BYTES_PER_VOXEL = 24
+SLICE_SHAPE = (512, 512)
+# Share of the physical RAM used when no memory budget is given
+DEFAULT_MEMORY_FRACTION = 0.8
+
+
+def count_slices(scan):
+    """
+    Number of slices of a pylidc scan without decoding any image: from the sorted file
+    names stored in the pylidc database, or by counting the .dcm files of the series.
+    """
+    names = getattr(scan, 'sorted_dicom_file_names', None)
+    if names:
+        return len(names.split(','))
+    return sum(1 for f in os.listdir(scan.get_path_to_dicom_files()) if f.endswith('.dcm'))
+
+
+def default_memory_budget(fraction=DEFAULT_MEMORY_FRACTION):
+    """``fraction`` of the physical RAM of the machine, in bytes."""
+    return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * fraction)
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS counter of this process (Linux >= 4.0). Returns False if not supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """Peak RSS of this process in bytes (VmHWM, or ru_maxrss if /proc is not available)."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run_measured(fn, args):
+    """Worker wrapper: run ``fn(*args)`` and return its result, its peak RSS and its wall time."""
+    _reset_peak_rss()
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, _peak_rss(), time.perf_counter() - start
+
+
+class MemoryEstimator:
+    """
+    Predicts the peak memory of a job from its slice count: ``base + voxels * bytes_per_voxel``.
+
+    The dtype policy is not part of the model: the peak is set by the arrays the worker holds
+    (DICOM pixel arrays, ``scan.to_volume()``), whose dtypes come from pydicom / pylidc; the
+    policy's storage dtype only changes the VolumeCache file written at the end.
+
+    Every finished job is recorded (predicted and actual peak RSS) in ``history_path``; once there
+    are enough records ``bytes_per_voxel`` is refitted as a high quantile of the observed cost, so
+    the estimate errs on the safe side.
+    """
+
+    def __init__(self, history_path="files/scheduler_history.json", base_bytes=DEFAULT_BASE_BYTES,
+                 bytes_per_voxel=DEFAULT_BYTES_PER_VOXEL, quantile=0.9, min_history=5):
+        self.history_path = Path(history_path) if history_path else None
+        self.base_bytes = base_bytes
+        self.bytes_per_voxel = bytes_per_voxel
+        self.quantile = quantile
+        self.min_history = min_history
+        self.history = []
+        if self.history_path and self.history_path.exists():
+            with open(self.history_path, 'r') as f:
+                self.history = json.load(f)
+        self.refit()
+
+    def predict(self, n_slices, slice_shape=SLICE_SHAPE):
+        return int(self.base_bytes + n_slices * slice_shape[0] * slice_shape[1] * self.bytes_per_voxel)
+
+    def record(self, key, n_slices, predicted, actual, seconds=None):
+        self.history.append({'key': key, 'n_slices': n_slices, 'predicted': predicted,
+                             'actual': actual, 'seconds': seconds})
+
+    def refit(self):
+        """Refit bytes_per_voxel from the history (no-op with fewer than ``min_history`` records)."""
+        records = [r for r in self.history if r['n_slices'] > 0]
+        if len(records) < self.min_history:
+            return
+        costs = [(r['actual'] - self.base_bytes) / (r['n_slices'] * SLICE_SHAPE[0] * SLICE_SHAPE[1]) for r in records]
+        self.bytes_per_voxel = max(float(np.quantile(costs, self.quantile)), 1.0)
+
+    def save(self):
+        if self.history_path:
+            self.history_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.history_path, 'w') as f:
+                json.dump(self.history, f, indent=4)
+
+
+class MemoryAwareScheduler:
+    """
+    Runs per-patient jobs on a process pool without exceeding a RAM budget.
+
+    Jobs are ordered by predicted peak memory, biggest first (big scans at the end would
+    make the tail). A job is started only when its prediction fits in the remaining budget;
+    when nothing fits the next smaller job is tried, and a job bigger than the whole budget
+    runs alone. Workers are spawned (not forked) so each one starts with a small heap and
+    its measured peak RSS belongs to its own jobs. Without ``memory_budget`` (bytes) the budget is
+    DEFAULT_MEMORY_FRACTION of the physical RAM.
+    """
+
+    def __init__(self, memory_budget=None, max_workers=None, estimator=None):
+        self.memory_budget = memory_budget if memory_budget is not None else default_memory_budget()
+        self.max_workers = max_workers or os.cpu_count()
+        self.estimator = estimator or MemoryEstimator()
+
+    def run(self, jobs, fn, extra_args=()):
+        """
+        Parameters:
+        - jobs: List of ``(key, n_slices)``; ``fn(*extra_args, key)`` is called for each one.
+        - fn: Picklable (module level) function.
+
+        Yields:
+        - tuple: ``(key, result)`` as jobs finish.
+        """
+        pending = sorted(((self.estimator.predict(n), key, n) for key, n in jobs), reverse=True)
+        running = {}
+        in_use = 0
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context) as pool:
+            try:
+                while pending or running:
+                    while pending and len(running) < self.max_workers:
+                        free = self.memory_budget - in_use
+                        idx = next((i for i, job in enumerate(pending) if job[0] <= free), None)
+                        if idx is None:
+                            if running:
+                                break
+                            idx = 0  # Bigger than the whole budget: run it alone
+                        predicted, key, n_slices = pending.pop(idx)
+                        future = pool.submit(_run_measured, fn, tuple(extra_args) + (key,))
+                        running[future] = (key, n_slices, predicted)
+                        in_use += predicted
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key, n_slices, predicted = running.pop(future)
+                        in_use -= predicted
+                        result, actual, seconds = future.result()
+                        self.estimator.record(key, n_slices, predicted, actual, seconds)
+                        yield key, result
+            finally:
+                self.estimator.refit()
+                self.estimator.save()
@@ -0,0 +1,276 @@
+import argparse
+import json
+import time
+from collections import defaultdict
+from configparser import ConfigParser
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from cache import VolumeCache, MaskCache, FeatureCache, RadiomicsCache
+from dtype_policy import DtypePolicy
+from scheduler import count_slices
+from shared_volumes import SharedVolumeRegistry, open_volume
+from utils import clip_hu_range, load_dicom_series
+from Nodule import AverageNodule
+
+# AverageNodule.get_annot_info keys -> column names used in the training table (notebook)
+ANNOTATION_COLUMNS = {
+    'mean_sphericity': 'Sphericity',
+    'mean_volume': 'Volume',
+    'mean_surface_area': 'Surface_area',
+    'mean_texture': 'Texture',
+    'mean_calcification': 'Calcification',
+    'mean_internal_structure': 'Internal_structure',
+    'mean_margin': 'Margin',
+    'mean_spiculation': 'Spiculation',
+    'mean_subtlety': 'Subtlety',
+    'mean_diameter': 'Diameter',
+    'mean_lobulation': 'Lobulation',
+}
+
+
+def nodule_radiomics(vol, mask, cbbox, mask_threshold, policy, extractor=None, cache=None):
+    """
+    Mean of the 'original' radiomics features over the nodule slices (as in output_media_nodulos.csv).
+    Slices whose mask has ``mask_threshold`` pixels or less are skipped.
+    """
+    from Mask import extract_radiomics
+
+    lung_np_array = clip_hu_range(np.asarray(vol[cbbox]))
+    values = defaultdict(list)
+    for nodule_slice in range(mask.shape[2]):
+        if np.sum(mask[:, :, nodule_slice]) <= mask_threshold:
+            continue
+        features = extract_radiomics(lung_np_array[:, :, nodule_slice], mask[:, :, nodule_slice],
+                                     policy, extractor, cache)
+        for key, value in features.items():
+            if key.startswith("original"):
+                values[key].append(float(value))
+    row = {key: float(np.mean(v)) for key, v in values.items()}
+    row['n_slices'] = len(next(iter(values.values()), []))
+    return row
+
+
+def _init_scoring_worker(radiomics_cache_path):
+    from Mask import enable_radiomics_cache
+    enable_radiomics_cache(radiomics_cache_path)
+
+
+def _nodule_radiomics_job(handle, mask, cbbox, mask_threshold, policy):
+    """Worker side of nodule_radiomics: the volume is mapped from shared memory, only the mask is pickled."""
+    with open_volume(handle) as vol:
+        return nodule_radiomics(vol, mask, cbbox, mask_threshold, policy)
+
+
+class MalignancyScorer:
+    """
+    Warm scorer: DICOM series -> per-nodule malignancy probabilities.
+
+    The configuration, the radiomics extractor and the XGBoost model are loaded once and reused
+    for every patient of the queue. Volumes, consensus masks and per-nodule features go through
+    the caches of cache.py, so rescoring a patient (e.g. with a new model) skips the expensive stages.
+
+    With ``workers`` > 1 the radiomics of the nodules of a patient run on a process pool; the
+    patient volume is published once in shared memory (SharedVolumeRegistry) and every job
+    receives a handle to it instead of a pickled copy.
+    """
+
+    def __init__(self, config_path='lung.conf', model_dir='files/model', cache_dir='data/cache', workers=1):
+        import pylidc as pl
+        from pylidc.utils import consensus
+        from radiomics.featureextractor import RadiomicsFeatureExtractor
+        from xgboost import XGBClassifier
+
+        parser = ConfigParser()
+        parser.read(config_path)
+        self.c_level = parser.getfloat('pylidc', 'confidence_level', fallback=0.5)
+        padding = parser.getint('pylidc', 'padding_size', fallback=512)
+        self.padding = [(padding, padding), (padding, padding), (0, 0)]
+        self.mask_threshold = parser.getint('prepare_dataset', 'Mask_Threshold', fallback=8)
+        self.policy = DtypePolicy.from_config(parser)
+
+        self._pl = pl
+        self._consensus = consensus
+        self.extractor = RadiomicsFeatureExtractor()
+        self.model = XGBClassifier()
+        self.model.load_model(Path(model_dir) / 'xgb_model.json')
+        with open(Path(model_dir) / 'model_meta.json', 'r') as f:
+            meta = json.load(f)
+        self.feature_names = meta['feature_names']
+        self.classes = {idx: label for label, idx in meta['class_mapping'].items()}
+
+        tag = "c{}_p{}_t{}".format(self.c_level, padding, self.mask_threshold)
+        self.volumes = VolumeCache(Path(cache_dir) / 'volume', self.policy)
+        self.masks = MaskCache(Path(cache_dir) / 'mask', tag)
+        self.features = FeatureCache(Path(cache_dir) / 'features', tag)
+        # Per-slice radiomics memoized by content: reused across settings changes that keep the crops identical
+        self.radiomics_cache = RadiomicsCache(Path(cache_dir) / 'radiomics.sqlite')
+        self.timings = defaultdict(list)
+
+        self.pool = None
+        self.shared = None
+        if workers > 1:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_scoring_worker,
+                                            initargs=(str(self.radiomics_cache.path),))
+            self.shared = SharedVolumeRegistry()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self.shared is not None:
+            self.shared.close()
+
+    @contextmanager
+    def _stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name].append(time.perf_counter() - start)
+
+    @staticmethod
+    def add_annotations(row, nodule):
+        """Add the averaged radiologist annotations (as in output_media_annotations.csv) to a feature row."""
+        annotations = AverageNodule(None, nodule, None).get_annot_info()
+        for key, column in ANNOTATION_COLUMNS.items():
+            row[column] = float(annotations[key])
+        return row
+
+    def nodule_features(self, vol, nodule, mask, cbbox):
+        """Radiomics (nodule_radiomics) plus annotations of one nodule, computed in this process."""
+        row = nodule_radiomics(vol, mask, cbbox, self.mask_threshold, self.policy, self.extractor, self.radiomics_cache)
+        return self.add_annotations(row, nodule)
+
+    def _parallel_features(self, pid, vol, nodules, masks):
+        """Features of the nodules missing from the FeatureCache, with the radiomics on the pool."""
+        rows = [self.features.load(pid, nodule_idx) for nodule_idx in range(len(nodules))]
+        missing = [nodule_idx for nodule_idx, row in enumerate(rows) if row is None]
+        if not missing:
+            return rows
+        handle = self.shared.publish(pid, vol, refs=len(missing))
+        futures = {}
+        for nodule_idx in missing:
+            mask, cbbox = masks[nodule_idx]
+            future = self.pool.submit(_nodule_radiomics_job, handle, mask, cbbox, self.mask_threshold, self.policy)
+            self.shared.release_when_done(pid, future)
+            futures[nodule_idx] = future
+        for nodule_idx, future in futures.items():
+            row = self.add_annotations(future.result(), nodules[nodule_idx])
+            rows[nodule_idx] = self.features.save(pid, nodule_idx, row)
+        return rows
+
+    def score_patient(self, patient_dir, scan=None):
+        """
+        Score every annotated nodule of one patient.
+
+        Parameters:
+        - patient_dir: Patient DICOM directory; its name is the LIDC patient id (LIDC-IDRI-XXXX).
+          Only the series of the pylidc scan is read, the annotations (and cbbox) refer to it.
+        - scan: Optional pylidc Scan already loaded for this patient.
+
+        Returns:
+        - list: One dict per nodule with the probability of every class.
+        """
+        pid = Path(patient_dir).name
+        with self._stage('annotations'):
+            if scan is None:
+                scan = self._pl.query(self._pl.Scan).filter(self._pl.Scan.patient_id == pid).first()
+            if scan is None:
+                print("No scan found for patient ID {}".format(pid))
+                return []
+            nodules = scan.cluster_annotations()
+        with self._stage('volume'):
+            vol = self.volumes.get(pid, lambda: load_dicom_series(patient_dir, self.policy, scan.series_instance_uid,
+                                                                  count_slices(scan)))
+
+        rows = []
+        if self.pool is not None:
+            with self._stage('consensus'):
+                masks = [self.masks.get(pid, nodule_idx, lambda: self._consensus(nodule, self.c_level, self.padding)[:2])
+                         for nodule_idx, nodule in enumerate(nodules)]
+            with self._stage('radiomics'):
+                rows = self._parallel_features(pid, vol, nodules, masks)
+        else:
+            for nodule_idx, nodule in enumerate(nodules):
+                with self._stage('consensus'):
+                    mask, cbbox = self.masks.get(pid, nodule_idx,
+                                                 lambda: self._consensus(nodule, self.c_level, self.padding)[:2])
+                with self._stage('radiomics'):
+                    rows.append(self.features.get(pid, nodule_idx,
+                                                  lambda: self.nodule_features(vol, nodule, mask, cbbox)))
+
+        results = []
+        if rows:
+            with self._stage('predict'):
+                X = np.array([[row.get(name, np.nan) for name in self.feature_names] for row in rows], dtype=np.float32)
+                probabilities = self.model.predict_proba(X)
+            for nodule_idx, (row, proba) in enumerate(zip(rows, probabilities)):
+                result = {'patient_id': pid, 'nodule_index': nodule_idx, 'n_slices': row['n_slices'],
+                          'prediction': self.classes[int(np.argmax(proba))]}
+                for idx, p in enumerate(proba):
+                    result['p_{}'.format(self.classes[idx])] = float(p)
+                results.append(result)
+        return results
+
+    def score_batch(self, patient_dirs):
+        """Score a queue of patient directories. Returns (results, elapsed seconds)."""
+        from Nodule import prefetch_scans
+
+        results = []
+        start = time.perf_counter()
+        with self._stage('prefetch'):
+            scans = prefetch_scans([Path(patient_dir).name for patient_dir in patient_dirs])
+        for patient_dir in patient_dirs:
+            with self._stage('patient'):
+                results.extend(self.score_patient(patient_dir, scans.get(Path(patient_dir).name)))
+        return results, time.perf_counter() - start
+
+    def latency_report(self):
+        """Mean / max latency in seconds of every stage."""
+        return {stage: {'n': len(t), 'mean': float(np.mean(t)), 'max': float(np.max(t))}
+                for stage, t in self.timings.items()}
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Batch malignancy scoring of LIDC patient DICOM series')
+    arg_parser.add_argument('patients', nargs='*', help='Patient DICOM directories (LIDC-IDRI-XXXX)')
+    arg_parser.add_argument('--queue', default=None, help='Text file with one patient directory per line')
+    arg_parser.add_argument('--config', default='lung.conf')
+    arg_parser.add_argument('--model-dir', default='files/model')
+    arg_parser.add_argument('--cache-dir', default='data/cache')
+    arg_parser.add_argument('--output', default='scores.csv')
+    arg_parser.add_argument('--target-spm', type=float, default=None, help='Target throughput in scans per minute')
+    arg_parser.add_argument('--workers', type=int, default=1, help='Processes computing the nodule radiomics')
+    args = arg_parser.parse_args()
+
+    patient_dirs = list(args.patients)
+    if args.queue:
+        with open(args.queue, 'r') as f:
+            patient_dirs.extend(line.strip() for line in f if line.strip())
+    if not patient_dirs:
+        arg_parser.error('No patients to score')
+
+    start = time.perf_counter()
+    scorer = MalignancyScorer(args.config, args.model_dir, args.cache_dir, args.workers)
+    print("Warm-up (imports, extractor, model): {:.2f} s".format(time.perf_counter() - start))
+
+    results, elapsed = scorer.score_batch(patient_dirs)
+    scorer.close()
+
+    import pandas as pd
+    pd.DataFrame(results).to_csv(args.output, index=False)
+
+    for stage, t in scorer.latency_report().items():
+        print("{:<12} n={:<5} mean={:.3f}s max={:.3f}s".format(stage, t['n'], t['mean'], t['max']))
+    print("Radiomics cache: {}".format(scorer.radiomics_cache.stats()))
+    spm = len(patient_dirs) / elapsed * 60 if elapsed > 0 else float('inf')
+    print("Scored {} scans ({} nodules) in {:.1f} s: {:.2f} scans/min".format(len(patient_dirs), len(results), elapsed, spm))
+    if args.target_spm is not None:
+        print("Target {:.2f} scans/min: {}".format(args.target_spm, 'reached' if spm >= args.target_spm else 'NOT reached'))
@@ -0,0 +1,128 @@
+import atexit
+import threading
+import uuid
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Everything a worker needs to map a published volume: picklable and a few bytes long,
+# whatever the size of the volume.
+VolumeHandle = namedtuple('VolumeHandle', ['key', 'name', 'shape', 'dtype'])
+
+
+def _attach(name):
+    """Attach to an existing segment without making this process responsible for unlinking it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python >= 3.13
+    except TypeError:
+        # Older Pythons register attached segments as well. Workers started by the owner share its
+        # resource tracker, where registration is a set and segments are only unlinked when the
+        # tracker shuts down (owner gone), so that extra registration is harmless. Unregistering
+        # here would drop the owner's registration: no cleanup if the owner crashes, and a
+        # KeyError from the tracker on every later unlink.
+        return shared_memory.SharedMemory(name=name)
+
+
+@contextmanager
+def open_volume(handle):
+    """
+    Worker side: read-only NumPy view of a published volume (no copy).
+
+    with open_volume(handle) as vol:
+        crop = vol[cbbox]
+    """
+    shm = _attach(handle.name)
+    vol = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+    vol.flags.writeable = False
+    try:
+        yield vol
+    finally:
+        del vol
+        shm.close()
+
+
+class SharedVolumeRegistry:
+    """
+    Owner side of the shared-memory volumes (scan HU arrays, lung masks, ...).
+
+    ``publish`` copies an array once into a shared memory segment and returns a VolumeHandle;
+    workers map it with ``open_volume`` instead of receiving a pickled copy, so the transfer
+    cost per job is the size of the handle. Every published volume is reference counted:
+    ``refs`` is the number of jobs that will use it, each ``release`` drops one reference and
+    the segment is unlinked at zero. Segments still alive are unlinked on ``close`` (also
+    called at exit), and if the owner process dies the multiprocessing resource tracker
+    unlinks them. Workers must be started by the owner (e.g. its ProcessPoolExecutor) so that
+    they share its resource tracker.
+    """
+
+    def __init__(self, prefix='liacd'):
+        self.prefix = prefix
+        self._segments = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self._segments
+
+    def publish(self, key, array, refs=1):
+        """Copy ``array`` into shared memory under ``key`` with ``refs`` references. Returns its handle."""
+        array = np.ascontiguousarray(array)
+        with self._lock:
+            if key in self._segments:
+                raise KeyError("Volume {!r} is already published".format(key))
+            name = "{}_{}".format(self.prefix, uuid.uuid4().hex[:16])
+            shm = shared_memory.SharedMemory(name=name, create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            handle = VolumeHandle(key, shm.name, array.shape, array.dtype.str)
+            self._segments[key] = [shm, handle, refs]
+        return handle
+
+    def handle(self, key):
+        return self._segments[key][1]
+
+    def acquire(self, key, refs=1):
+        """Add references to a published volume (e.g. more jobs submitted). Returns its handle."""
+        with self._lock:
+            segment = self._segments[key]
+            segment[2] += refs
+            return segment[1]
+
+    def release(self, key):
+        """Drop one reference; the segment is unlinked when none is left."""
+        with self._lock:
+            segment = self._segments.get(key)
+            if segment is None:
+                return
+            segment[2] -= 1
+            if segment[2] > 0:
+                return
+            del self._segments[key]
+        self._unlink(segment[0])
+
+    def release_when_done(self, key, future):
+        """Release one reference of ``key`` when ``future`` finishes, whether it succeeded, failed or crashed."""
+        future.add_done_callback(lambda _: self.release(key))
+
+    def close(self):
+        """Unlink every segment still published."""
+        with self._lock:
+            segments = list(self._segments.values())
+            self._segments.clear()
+        for shm, _, _ in segments:
+            self._unlink(shm)
+
+    @staticmethod
+    def _unlink(shm):
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,211 @@
+import argparse
+import json
+from configparser import ConfigParser
+from pathlib import Path
+
+import numpy as np
+
+from dtype_policy import DtypePolicy
+from utils import is_dir_path, segment_lung
+
+# One row per consensus slice of every nodule, whether it passes mask_threshold or not.
+# bbox/centroid are in crop coordinates (crop origin: crop_row0, crop_col0), z is the volume slice.
+INDEX_COLUMNS = ['patient_id', 'nodule_no', 'slice_no', 'z', 'crop_row0', 'crop_col0',
+                 'mask_pixels', 'bbox_row_min', 'bbox_row_max', 'bbox_col_min', 'bbox_col_max',
+                 'centroid_row', 'centroid_col', 'hu_min', 'hu_max', 'hu_mean', 'hu_std',
+                 'malignancy', 'is_cancer']
+# Columns of meta_info.csv. is_virtual marks the clean rows drawn by CleanSliceSampler (no files on disk)
+META_COLUMNS = ['patient_id', 'nodule_no', 'slice_no', 'original_image', 'mask_image', 'malignancy', 'is_cancer',
+                'is_clean', 'is_virtual']
+INDEX_FILE = 'slice_index.csv'
+
+
+def slice_stats(pid, nodule_idx, nodule_slice, mask_slice, hu_slice, cbbox, malignancy, cancer_label):
+    """
+    Statistics of one consensus slice: mask pixel count, bbox, centroid and HU summary under the mask.
+
+    Parameters:
+    - pid: Patient ID (LIDC-IDRI-XXXX).
+    - nodule_idx, nodule_slice: Nodule index and slice index inside the consensus crop.
+    - mask_slice, hu_slice: 2D consensus mask and HU crop of the slice.
+    - cbbox: Consensus bbox (tuple of slices) of the crop in the volume.
+    - malignancy, cancer_label: Output of calculate_malignancy.
+
+    Returns:
+    - list: Values in INDEX_COLUMNS order.
+    """
+    rows, cols = np.nonzero(mask_slice)
+    n_pixels = len(rows)
+    if n_pixels:
+        values = np.asarray(hu_slice)[rows, cols]
+        geometry = [rows.min(), rows.max(), cols.min(), cols.max(), rows.mean(), cols.mean(),
+                    values.min(), values.max(), values.mean(), values.std()]
+    else:
+        geometry = [np.nan] * 10
+    return [pid, nodule_idx, nodule_slice, cbbox[2].start + nodule_slice, cbbox[0].start, cbbox[1].start,
+            n_pixels] + [float(v) for v in geometry] + [malignancy, cancer_label]
+
+
+def nodule_file_names(pid, nodule_idx, nodule_slice):
+    """Naming of each file: NI= Nodule Image, MA= Mask Original (same as MakeDataSet)."""
+    nodule_name = "{}_NI{}_slice{}".format(pid[-4:], str(nodule_idx).zfill(3), str(nodule_slice).zfill(3))
+    mask_name = "{}_MA{}_slice{}".format(pid[-4:], str(nodule_idx).zfill(3), str(nodule_slice).zfill(3))
+    return nodule_name, mask_name
+
+
+def save_nodule_slice(pid, nodule_idx, nodule_slice, hu_slice, mask_slice, patient_image_dir, patient_mask_dir, policy=None):
+    """
+    Segment the lung of one nodule slice and save image and mask (.npy).
+
+    Returns:
+    - tuple: (nodule_name, mask_name, standardization stats of segment_lung).
+    """
+    lung_segmented_np_array, stats = segment_lung(hu_slice, policy, return_stats=True)
+    # Some values are stored as -0. <- this may result in datatype error in pytorch training
+    lung_segmented_np_array[lung_segmented_np_array == -0] = 0
+    nodule_name, mask_name = nodule_file_names(pid, nodule_idx, nodule_slice)
+    np.save(Path(patient_image_dir) / nodule_name, lung_segmented_np_array)
+    np.save(Path(patient_mask_dir) / mask_name, mask_slice)
+    return nodule_name, mask_name, stats
+
+
+def load_index(meta_path):
+    import pandas as pd
+
+    return pd.read_csv(Path(meta_path) / INDEX_FILE)
+
+
+def filter_index(index, mask_threshold):
+    """
+    Vectorized equivalent of the ``np.sum(mask) <= mask_threshold`` filter of prepare_dataset.
+
+    Returns:
+    - DataFrame: meta_info.csv rows (META_COLUMNS) of the admitted slices, plus the full patient id
+      in 'pid' so that the slices can be located on disk.
+    """
+    import pandas as pd
+
+    admitted = index[index['mask_pixels'] > mask_threshold]
+    short_pid = admitted['patient_id'].str[-4:]
+    nodule = admitted['nodule_no'].astype(str).str.zfill(3)
+    slice_no = admitted['slice_no'].astype(str).str.zfill(3)
+    return pd.DataFrame({
+        'patient_id': short_pid,
+        'nodule_no': admitted['nodule_no'],
+        'slice_no': slice_no,
+        'original_image': short_pid + '_NI' + nodule + '_slice' + slice_no,
+        'mask_image': short_pid + '_MA' + nodule + '_slice' + slice_no,
+        'malignancy': admitted['malignancy'],
+        'is_cancer': admitted['is_cancer'],
+        'is_clean': False,
+        'is_virtual': False,
+        'pid': admitted['patient_id'],
+    })
+
+
+def missing_slices(meta, image_dir):
+    """Rows of ``meta`` (from filter_index) whose image has not been generated yet."""
+    exists = [(Path(image_dir) / pid / (name + '.npy')).exists() for pid, name in zip(meta['pid'], meta['original_image'])]
+    return meta[~np.array(exists, dtype=bool)]
+
+
+def materialize(meta, image_dir, mask_dir, confidence_level=0.5, padding=512, policy=None):
+    """
+    Generate the image/mask files of the given rows (output of missing_slices).
+    Only the patients and nodules that appear in ``meta`` are loaded.
+
+    Returns:
+    - dict: Standardization stats of every generated slice, by image name (as in dtype_policy.json).
+    """
+    from pylidc.utils import consensus
+    from Nodule import iter_scans
+
+    pad = [(padding, padding), (padding, padding), (0, 0)]
+    normalization = {}
+    by_patient = meta.groupby('pid')
+    for pid, scan in iter_scans(list(by_patient.groups)):
+        if scan is None:
+            print("No scan found for patient ID {}".format(pid))
+            continue
+        patient_image_dir = Path(image_dir) / pid
+        patient_mask_dir = Path(mask_dir) / pid
+        patient_image_dir.mkdir(parents=True, exist_ok=True)
+        patient_mask_dir.mkdir(parents=True, exist_ok=True)
+
+        vol = scan.to_volume()
+        nodules_annotation = scan.cluster_annotations()
+        for nodule_idx, rows in by_patient.get_group(pid).groupby('nodule_no'):
+            mask, cbbox, _ = consensus(nodules_annotation[nodule_idx], confidence_level, pad)
+            lung_np_array = vol[cbbox]
+            for nodule_slice in rows['slice_no'].astype(int):
+                nodule_name, _, stats = save_nodule_slice(pid, nodule_idx, nodule_slice, lung_np_array[:, :, nodule_slice],
+                                                          mask[:, :, nodule_slice], patient_image_dir, patient_mask_dir, policy)
+                normalization[nodule_name] = stats
+    return normalization
+
+
+def update_normalization(meta_path, normalization, policy=None):
+    """Merge per-slice standardization stats into dtype_policy.json (created if missing)."""
+    path = Path(meta_path) / 'dtype_policy.json'
+    saved = {'policy': (policy or DtypePolicy()).to_dict(), 'normalization': {}}
+    if path.exists():
+        with open(path, 'r') as f:
+            saved = json.load(f)
+    saved['normalization'].update(normalization)
+    tmp = path.with_name('dtype_policy.tmp.json')
+    with open(tmp, 'w') as f:
+        json.dump(saved, f, indent=4)
+    tmp.replace(path)
+
+
+def rethreshold(meta_path, image_dir, mask_dir, mask_threshold, confidence_level=0.5, padding=512, policy=None, generate=True):
+    """
+    Apply a new mask threshold from the slice index: writes a new meta_info.csv (nodule rows + the clean
+    rows of the previous one) and generates only the slices that were not admitted before. The
+    standardization stats of the new slices are added to dtype_policy.json.
+
+    Returns:
+    - DataFrame: The rows that had to be generated.
+    """
+    import pandas as pd
+
+    meta_path = Path(meta_path)
+    meta = filter_index(load_index(meta_path), mask_threshold)
+    new_rows = missing_slices(meta, image_dir)
+    if not generate:
+        return new_rows
+    if len(new_rows):
+        update_normalization(meta_path, materialize(new_rows, image_dir, mask_dir, confidence_level, padding, policy),
+                             policy)
+
+    meta = meta[META_COLUMNS]
+    previous = meta_path / 'meta_info.csv'
+    if previous.exists():
+        # Keep the zero-padded ids ('0002', '005') of the rows written back
+        old_meta = pd.read_csv(previous, dtype={'patient_id': str, 'slice_no': str})
+        if 'is_virtual' not in old_meta:
+            old_meta['is_virtual'] = False  # meta_info.csv written before the column existed
+        meta = pd.concat([meta, old_meta[old_meta['is_clean'] == True]], ignore_index=True)
+    meta.to_csv(previous, index=False)
+    return new_rows
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Re-filter the nodule slices with a new mask threshold using the slice index')
+    arg_parser.add_argument('--threshold', type=int, default=None, help='Mask threshold (default: Mask_Threshold of lung.conf)')
+    arg_parser.add_argument('--config', default='lung.conf')
+    arg_parser.add_argument('--dry-run', action='store_true', help='Only report how many slices would be generated')
+    args = arg_parser.parse_args()
+
+    parser = ConfigParser()
+    parser.read(args.config)
+    threshold = args.threshold if args.threshold is not None else parser.getint('prepare_dataset', 'Mask_Threshold')
+    new_rows = rethreshold(is_dir_path(parser.get('prepare_dataset', 'META_PATH')),
+                           parser.get('prepare_dataset', 'IMAGE_PATH'),
+                           parser.get('prepare_dataset', 'MASK_PATH'),
+                           threshold,
+                           parser.getfloat('pylidc', 'confidence_level'),
+                           parser.getint('pylidc', 'padding_size'),
+                           DtypePolicy.from_config(parser),
+                           generate=not args.dry_run)
+    print("Mask threshold {}: {} newly admitted slices{}".format(threshold, len(new_rows), ' (not generated)' if args.dry_run else ''))
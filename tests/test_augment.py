@@ -0,0 +1,77 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('scipy')
+
+from augment import AugmentedBatches, BatchAugmenter, SliceLoader
+from slice_index import META_COLUMNS
+
+SIZE = 16
+
+
+class FakeSampler:
+    """Stands in for CleanSliceSampler: 2 virtual slices of LIDC-IDRI-0002, a different pair every epoch."""
+
+    def __init__(self):
+        self.loaded = []
+
+    def sample(self, epoch=0):
+        rows = []
+        for z in (2 * epoch, 2 * epoch + 1):
+            name = 'LIDC-IDRI-0002/0002_CN001_slice{:03d}'.format(z)
+            rows.append(['0002', z, str(z).zfill(3), name, name.replace('CN', 'MA'), 0, False, True, True])
+        return pd.DataFrame(rows, columns=META_COLUMNS)
+
+    def load(self, name):
+        self.loaded.append(name)
+        return np.ones((SIZE, SIZE), dtype=np.float32), np.zeros((SIZE, SIZE), dtype=bool)
+
+    def volume(self, pid):
+        return np.full((SIZE, SIZE, 64), -700, dtype=np.int16)
+
+
+def make_loader(tmp_path, sampler):
+    pid_dir = tmp_path / 'images' / 'LIDC-IDRI-0001'
+    mask_dir = tmp_path / 'masks' / 'LIDC-IDRI-0001'
+    pid_dir.mkdir(parents=True)
+    mask_dir.mkdir(parents=True)
+    rows, normalization = [], {}
+    for z in range(2):
+        name, mask_name = '0001_NI000_slice{:03d}'.format(z), '0001_MA000_slice{:03d}'.format(z)
+        np.save(pid_dir / (name + '.npy'), np.ones((SIZE, SIZE), dtype=np.float32))
+        np.save(mask_dir / (mask_name + '.npy'), np.ones((SIZE, SIZE), dtype=bool))
+        normalization[name] = {'mean': -600.0, 'std': 100.0}
+        rows.append(['0001', 0, str(z).zfill(3), name, mask_name, 4, 'True', False, False])
+    meta = pd.concat([pd.DataFrame(rows, columns=META_COLUMNS), sampler.sample(0)], ignore_index=True)
+    return SliceLoader(meta, tmp_path / 'images', tmp_path / 'masks', normalization, clean_sampler=sampler, size=SIZE)
+
+
+def test_for_epoch_redraws_virtual_rows(tmp_path):
+    sampler = FakeSampler()
+    loader = make_loader(tmp_path, sampler)
+
+    epoch_1 = loader.for_epoch(1)
+    assert epoch_1 is loader.for_epoch(1)
+    assert len(epoch_1) == len(loader)
+    virtual = epoch_1.meta[epoch_1.meta['is_virtual']]
+    assert list(virtual['slice_no']) == ['002', '003']
+    # Nodule rows and their labels are kept
+    assert list(epoch_1.meta.loc[~epoch_1.meta['is_virtual'], 'original_image']) == ['0001_NI000_slice000', '0001_NI000_slice001']
+    assert list(epoch_1.labels) == [1, 1, 0, 0]
+    # Without a sampler the meta_info.csv rows are used as they are
+    loader.clean_sampler = None
+    assert loader.for_epoch(1) is loader
+
+
+def test_iter_epoch_loads_the_epoch_draw(tmp_path):
+    sampler = FakeSampler()
+    loader = make_loader(tmp_path, sampler)
+    augmenter = BatchAugmenter(max_rotation=0.0)
+
+    with AugmentedBatches(loader, augmenter, batch_size=3, workers=1, prefetch=2) as batches:
+        for epoch in range(3):
+            sampler.loaded.clear()
+            labels = np.concatenate([batch[2] for batch in batches.iter_epoch(epoch)])
+            assert sorted(labels.tolist()) == [0, 0, 1, 1]
+            assert sorted(sampler.loaded) == list(sampler.sample(epoch)['original_image'])
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('sklearn')
+
+from feature_reduction import ID_COLUMNS, StreamingPCA
+
+FEATURES = ['original_firstorder_Mean', 'original_firstorder_Median', 'original_glcm_Idmn', 'original_shape2D_Sphericity']
+
+
+def write_radiomics_json(path, seed=0):
+    """Radiomics JSON shape (patient -> nodule -> slice -> features); returns the dense matrix in file order."""
+    rng = np.random.default_rng(seed)
+    data, rows = {}, []
+    for patient in range(3):
+        nodules = {}
+        for nodule in range(2):
+            slices = {}
+            for z in range(5):
+                values = rng.normal(size=len(FEATURES)) * [100, 50, 1, 0.1] + [-500, -480, 0.9, 0.8]
+                rows.append(values)
+                slices[str(z)] = dict(zip(FEATURES, values.tolist()),
+                                      diagnostics_Versions_PyRadiomics='v3.0.1',
+                                      original_shape2D_BoundingBox=[1, 2, 3, 4])
+            nodules[str(nodule)] = slices
+        data['LIDC-IDRI-{:04d}'.format(patient + 1)] = nodules
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    return np.array(rows)
+
+
+def test_fit_transform_save_load(tmp_path):
+    from sklearn.decomposition import PCA
+    from sklearn.preprocessing import StandardScaler
+
+    json_path = tmp_path / 'radiomics.json'
+    X = write_radiomics_json(json_path)
+
+    # chunk_size 7: the 30 rows are fitted in several chunks, the last one merged (_min_rows_chunks)
+    pca = StreamingPCA(n_components=len(FEATURES), chunk_size=7).fit(json_path)
+    assert pca.feature_names == sorted(FEATURES)
+    assert pca.n_samples == len(X)
+
+    X = X[:, [FEATURES.index(name) for name in pca.feature_names]]
+    expected = PCA(n_components=len(FEATURES)).fit_transform(StandardScaler().fit_transform(X))
+    reduced = pca.transform(X)
+    # Components are defined up to their sign
+    signs = np.sign(np.sum(reduced * expected, axis=0))
+    np.testing.assert_allclose(reduced * signs, expected, atol=1e-6)
+
+    model_path = tmp_path / 'pca_model.npz'
+    pca.save(model_path)
+    loaded = StreamingPCA.load(model_path)
+    assert loaded.feature_names == pca.feature_names
+    np.testing.assert_allclose(loaded.transform(X), reduced)
+
+    csv_path = tmp_path / 'pca_features.csv'
+    loaded.transform_to_csv(json_path, csv_path)
+    table = pd.read_csv(csv_path)
+    assert len(table) == len(X)
+    assert list(table.columns) == ID_COLUMNS + ['PC{}'.format(i + 1) for i in range(len(FEATURES))]
+    np.testing.assert_allclose(table[['PC{}'.format(i + 1) for i in range(len(FEATURES))]].to_numpy(), reduced, atol=1e-9)
+
+
+def test_fit_needs_enough_rows(tmp_path):
+    path = tmp_path / 'radiomics.json'
+    features = {'original_firstorder_Mean': 1.0, 'original_firstorder_Median': 2.0, 'original_glcm_Idmn': 3.0}
+    with open(path, 'w') as f:
+        json.dump({'LIDC-IDRI-0001': {'0': {'0': features, '1': features}}}, f)
+
+    with pytest.raises(ValueError, match='rows'):
+        StreamingPCA(n_components=3, chunk_size=7).fit(path)
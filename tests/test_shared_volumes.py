@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+import textwrap
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('numpy')
+
+pytestmark = pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs POSIX shared memory in /dev/shm')
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# Owner process: publishes a volume, has a spawned worker read it, then prints the segment name
+OWNER = textwrap.dedent('''
+    import multiprocessing
+    import os
+    import sys
+    from concurrent.futures import ProcessPoolExecutor
+
+    import numpy as np
+
+    from shared_volumes import SharedVolumeRegistry, open_volume
+
+
+    def total(handle):
+        with open_volume(handle) as vol:
+            return int(vol.sum())
+
+
+    if __name__ == '__main__':
+        registry = SharedVolumeRegistry(prefix='liacdtest')
+        vol = np.arange(4 * 5 * 6, dtype=np.int16).reshape(4, 5, 6)
+        handle = registry.publish('LIDC-IDRI-0001', vol, refs=2)
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for _ in range(2):
+                future = pool.submit(total, handle)
+                registry.release_when_done('LIDC-IDRI-0001', future)
+                assert future.result() == int(vol.sum())
+        print(handle.name, flush=True)
+        if sys.argv[1] == 'crash':
+            # Republish and die without any cleanup (no close, no atexit)
+            print(registry.publish('LIDC-IDRI-0002', vol).name, flush=True)
+            os._exit(1)
+        registry.close()
+''')
+
+
+def run_owner(tmp_path, mode):
+    # Run from a file: spawned workers re-import the owner's __main__ to find ``total``
+    script = tmp_path / 'owner.py'
+    script.write_text(OWNER)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(REPO_DIR), os.environ.get('PYTHONPATH')])))
+    return subprocess.run([sys.executable, str(script), mode], cwd=REPO_DIR, env=env,
+                          capture_output=True, text=True, timeout=120)
+
+
+def wait_unlinked(name, timeout=10):
+    deadline = time.time() + timeout
+    while Path('/dev/shm', name).exists() and time.time() < deadline:
+        time.sleep(0.1)
+    return not Path('/dev/shm', name).exists()
+
+
+def test_release_after_workers_is_clean(tmp_path):
+    result = run_owner(tmp_path, 'clean')
+    assert result.returncode == 0, result.stderr
+    name = result.stdout.split()[0]
+    assert wait_unlinked(name)
+    # A worker must not drop the owner's resource tracker registration (KeyError on unlink)
+    assert 'Traceback' not in result.stderr, result.stderr
+    assert 'leaked' not in result.stderr, result.stderr
+
+
+def test_owner_crash_unlinks_segments(tmp_path):
+    result = run_owner(tmp_path, 'crash')
+    assert result.returncode == 1, result.stderr
+    released, leaked = result.stdout.split()[:2]
+    assert wait_unlinked(released)
+    # Left to the resource tracker, which unlinks it once the owner is gone
+    assert wait_unlinked(leaked)
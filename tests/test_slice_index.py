@@ -0,0 +1,76 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+from slice_index import INDEX_COLUMNS, INDEX_FILE, META_COLUMNS, filter_index, rethreshold
+
+
+def index_row(pid, nodule_no, slice_no, mask_pixels, malignancy=4, is_cancer=True):
+    row = dict.fromkeys(INDEX_COLUMNS, 0.0)
+    row.update(patient_id=pid, nodule_no=nodule_no, slice_no=slice_no, z=slice_no + 40, mask_pixels=mask_pixels,
+               malignancy=malignancy, is_cancer=is_cancer)
+    return row
+
+
+def make_index():
+    return pd.DataFrame([
+        index_row('LIDC-IDRI-0002', 0, 4, 5),
+        index_row('LIDC-IDRI-0002', 0, 5, 20),
+        index_row('LIDC-IDRI-0002', 1, 0, 9, malignancy=3, is_cancer='Ambiguous'),
+        index_row('LIDC-IDRI-0010', 0, 12, 8, malignancy=1, is_cancer=False),
+    ], columns=INDEX_COLUMNS)
+
+
+def clean_meta():
+    return pd.DataFrame([['0003', 5, '005', 'LIDC-IDRI-0003/0003_CN001_slice005', 'LIDC-IDRI-0003/0003_CM001_slice005',
+                          0, False, True, False]], columns=META_COLUMNS)
+
+
+def test_filter_index():
+    meta = filter_index(make_index(), mask_threshold=8)
+
+    assert meta['original_image'].tolist() == ['0002_NI000_slice005', '0002_NI001_slice000']
+    assert meta['mask_image'].tolist() == ['0002_MA000_slice005', '0002_MA001_slice000']
+    assert meta['patient_id'].tolist() == ['0002', '0002']
+    assert meta['slice_no'].tolist() == ['005', '000']
+    assert meta['pid'].tolist() == ['LIDC-IDRI-0002', 'LIDC-IDRI-0002']
+    assert not meta['is_clean'].any() and not meta['is_virtual'].any()
+    assert len(filter_index(make_index(), mask_threshold=4)) == 4
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    meta_dir, image_dir, mask_dir = tmp_path / 'meta', tmp_path / 'image', tmp_path / 'mask'
+    meta_dir.mkdir()
+    make_index().to_csv(meta_dir / INDEX_FILE, index=False)
+    clean_meta().to_csv(meta_dir / 'meta_info.csv', index=False)
+    # Slices admitted by threshold 8 are already on disk
+    for pid, name in [('LIDC-IDRI-0002', '0002_NI000_slice005'), ('LIDC-IDRI-0002', '0002_NI001_slice000')]:
+        (image_dir / pid).mkdir(parents=True, exist_ok=True)
+        np.save(image_dir / pid / name, np.zeros((2, 2), dtype=np.float32))
+    return meta_dir, image_dir, mask_dir
+
+
+def test_rethreshold_dry_run(dataset):
+    meta_dir, image_dir, mask_dir = dataset
+    before = (meta_dir / 'meta_info.csv').read_text()
+
+    new_rows = rethreshold(meta_dir, image_dir, mask_dir, mask_threshold=4, generate=False)
+
+    assert new_rows['original_image'].tolist() == ['0002_NI000_slice004', '0010_NI000_slice012']
+    assert (meta_dir / 'meta_info.csv').read_text() == before
+
+
+def test_rethreshold_keeps_zero_padded_ids(dataset):
+    meta_dir, image_dir, mask_dir = dataset
+
+    # Nothing to generate: only meta_info.csv is rewritten
+    assert len(rethreshold(meta_dir, image_dir, mask_dir, mask_threshold=8)) == 0
+    assert len(rethreshold(meta_dir, image_dir, mask_dir, mask_threshold=8)) == 0
+
+    meta = pd.read_csv(meta_dir / 'meta_info.csv', dtype=str)
+    assert list(meta.columns) == META_COLUMNS
+    assert meta['patient_id'].tolist() == ['0002', '0002', '0003']
+    assert meta['slice_no'].tolist() == ['005', '000', '005']
+    assert meta['original_image'].tolist()[-1] == 'LIDC-IDRI-0003/0003_CN001_slice005'
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from utils import iter_json_items
+
+
+def radiomics_json():
+    """Same shape as the radiomics JSON: patient -> nodule -> slice -> features."""
+    data = {}
+    for patient in range(3):
+        nodules = {}
+        for nodule in range(2):
+            nodules[str(nodule)] = {
+                str(z): {
+                    'diagnostics_Versions_PyRadiomics': 'v3.0.1',
+                    'diagnostics_Image-original_Spacing': [0.703125, 0.703125],
+                    'diagnostics_Mask-original_BoundingBox': [12, 7, 1, 25, 19, 1],
+                    'original_shape2D_Sphericity': 0.8731542356781234 + z,
+                    'original_firstorder_Mean': -512.25 - patient,
+                    'original_firstorder_Energy': 123456789012.5 * (nodule + 1),
+                    'original_glcm_Idmn': 1e-05,
+                    'original_firstorder_Kurtosis': None,
+                    'label': 'nodule "{}" \\ {}'.format(nodule, z),
+                }
+                for z in range(3)
+            }
+        data['LIDC-IDRI-{:04d}'.format(patient + 1)] = nodules
+    return data
+
+
+@pytest.mark.parametrize('indent', [None, 4])
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1 << 20])
+def test_iter_json_items_matches_json_load(tmp_path, indent, chunk_size):
+    path = tmp_path / 'radiomics.json'
+    with open(path, 'w') as f:
+        json.dump(radiomics_json(), f, indent=indent)
+    with open(path, 'r') as f:
+        expected = json.load(f)
+
+    items = list(iter_json_items(path, chunk_size=chunk_size))
+
+    assert [key for key, _ in items] == list(expected)
+    assert dict(items) == expected
+
+
+def test_iter_json_items_empty_object(tmp_path):
+    path = tmp_path / 'empty.json'
+    path.write_text('  {  }  ')
+    assert list(iter_json_items(path, chunk_size=7)) == []
+
+
+def test_iter_json_items_truncated(tmp_path):
+    path = tmp_path / 'truncated.json'
+    path.write_text(json.dumps(radiomics_json())[:-20])
+    with pytest.raises(ValueError):
+        list(iter_json_items(path, chunk_size=7))
@@ -0,0 +1,294 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+LABEL_COLUMN = 'Malignancy_al'
+GROUP_COLUMN = 'patient_id'
+UNLABELED = 'Unlabeled'
+# Columns of files/SMOTE.csv that are not features
+DROP_COLUMNS = ['patient_id', 'nodule_index', 'Malignancy', 'Malignancy_al']
+
+# Default search space for XGBClassifier
+PARAM_GRID = {
+    'n_estimators': [100, 200, 400],
+    'max_depth': [3, 4, 6, 8],
+    'learning_rate': [0.01, 0.05, 0.1, 0.3],
+    'subsample': [0.7, 0.85, 1.0],
+    'colsample_bytree': [0.5, 0.75, 1.0],
+    'min_child_weight': [1, 3, 5],
+}
+
+# Training matrix shared by the worker processes (memory-mapped, see _init_worker)
+_DATASET = None
+
+
+def _source_signature(csv_path):
+    stat = os.stat(csv_path)
+    return {'path': str(Path(csv_path).resolve()), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def load_training_matrix(csv_path="files/SMOTE.csv", cache_dir="files/cache", mmap_mode='r'):
+    """
+    Load the labeled training matrix, parsing the CSV only the first time.
+
+    The filtered matrix (``Malignancy_al != "Unlabeled"``) is cached as .npy files
+    (float32 features, int labels, int patient groups) plus a meta.json with the
+    feature names and class mapping. The cache is rebuilt when the CSV changes.
+
+    Parameters:
+    - csv_path (str): CSV generado en el notebook (files/SMOTE.csv).
+    - cache_dir (str): Directorio de la caché binaria.
+    - mmap_mode (str): Passed to np.load; 'r' shares the pages between processes.
+
+    Returns:
+    - tuple: (X, y, groups, meta)
+    """
+    cache_dir = Path(cache_dir)
+    meta_path = cache_dir / 'meta.json'
+    signature = _source_signature(csv_path)
+
+    if meta_path.exists():
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if meta['source'] == signature:
+            return _load_cached(cache_dir, meta, mmap_mode)
+
+    import pandas as pd
+
+    data = pd.read_csv(csv_path)
+    data = data[data[LABEL_COLUMN] != UNLABELED]
+    X = data.drop(columns=DROP_COLUMNS).to_numpy(dtype=np.float32)
+    classes = sorted(data[LABEL_COLUMN].astype(str).unique())
+    class_mapping = {label: idx for idx, label in enumerate(classes)}
+    y = data[LABEL_COLUMN].astype(str).map(class_mapping).to_numpy(dtype=np.int64)
+    patients = sorted(data[GROUP_COLUMN].astype(str).unique())
+    patient_mapping = {pid: idx for idx, pid in enumerate(patients)}
+    groups = data[GROUP_COLUMN].astype(str).map(patient_mapping).to_numpy(dtype=np.int64)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    np.save(cache_dir / 'X.npy', X)
+    np.save(cache_dir / 'y.npy', y)
+    np.save(cache_dir / 'groups.npy', groups)
+    meta = {
+        'source': signature,
+        'feature_names': [c for c in data.columns if c not in DROP_COLUMNS],
+        'class_mapping': class_mapping,
+        'patients': patients,
+    }
+    # meta.json is written last: it marks the cache as complete
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=4)
+    return _load_cached(cache_dir, meta, mmap_mode)
+
+
+def _load_cached(cache_dir, meta, mmap_mode):
+    X = np.load(cache_dir / 'X.npy', mmap_mode=mmap_mode)
+    y = np.load(cache_dir / 'y.npy', mmap_mode=mmap_mode)
+    groups = np.load(cache_dir / 'groups.npy', mmap_mode=mmap_mode)
+    return X, y, groups, meta
+
+
+def make_folds(y, groups, n_splits=5, seed=42):
+    """
+    Assign every row to a fold, grouping by patient so slices/nodules of one patient never
+    end up on both sides of a split. Returns an int array with the fold of each row.
+    """
+    from sklearn.model_selection import StratifiedGroupKFold
+
+    folds = np.empty(len(y), dtype=np.int64)
+    splitter = StratifiedGroupKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+    for fold, (_, val_idx) in enumerate(splitter.split(np.zeros(len(y)), y, groups)):
+        folds[val_idx] = fold
+    return folds
+
+
+def apply_smote(X, y, seed=42):
+    """
+    Oversample every class up to the majority class, as in the notebook.
+    k_neighbors is reduced for very small classes; classes with a single sample are left as is.
+    """
+    from imblearn.over_sampling import SMOTE
+
+    classes, counts = np.unique(y, return_counts=True)
+    if len(classes) < 2 or counts.min() < 2:
+        return X, y
+    sampling_strategy = {label: int(counts.max()) for label in classes}
+    smote = SMOTE(sampling_strategy=sampling_strategy, k_neighbors=min(5, int(counts.min()) - 1), random_state=seed)
+    return smote.fit_resample(X, y)
+
+
+def trial_key(params):
+    """Stable identifier of a hyperparameter set (used to resume searches)."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def search_signature(meta, n_splits, seed):
+    """
+    Identifier of the data and splits a search runs on: the training CSV (``meta['source']``),
+    the number of folds and the seed. Results are only resumed under the same signature.
+    """
+    description = {'source': meta['source'], 'n_splits': n_splits, 'seed': seed}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()[:16], description
+
+
+def _init_worker(csv_path, cache_dir):
+    global _DATASET
+    X, y, groups, meta = load_training_matrix(csv_path, cache_dir)
+    _DATASET = (X, y, meta)
+
+
+def run_fold(params, fold, folds, seed=42, n_threads=1):
+    """
+    Train on every fold but ``fold`` (with SMOTE applied to the training part only) and
+    evaluate on ``fold``. Runs in a worker process on the shared memory-mapped dataset.
+    """
+    from sklearn.metrics import accuracy_score, balanced_accuracy_score, f1_score
+    from xgboost import XGBClassifier
+
+    X, y, meta = _DATASET
+    train_idx = np.flatnonzero(folds != fold)
+    val_idx = np.flatnonzero(folds == fold)
+    X_train, y_train = apply_smote(X[train_idx], y[train_idx], seed)
+
+    n_classes = len(meta['class_mapping'])
+    model = XGBClassifier(**params, random_state=seed, n_jobs=n_threads,
+                          eval_metric='logloss' if n_classes == 2 else 'mlogloss')
+    model.fit(X_train, y_train)
+    y_pred = model.predict(X[val_idx])
+    return {
+        'accuracy': float(accuracy_score(y[val_idx], y_pred)),
+        'balanced_accuracy': float(balanced_accuracy_score(y[val_idx], y_pred)),
+        'f1_macro': float(f1_score(y[val_idx], y_pred, average='macro')),
+        'n_train': int(len(y_train)),
+        'n_val': int(len(val_idx)),
+    }
+
+
+def load_results(results_path):
+    """Read the fold results already written by previous (possibly interrupted) searches."""
+    results = []
+    if os.path.exists(results_path):
+        with open(results_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    results.append(json.loads(line))
+    return results
+
+
+def summarize(results, metric='balanced_accuracy'):
+    """Mean/std of ``metric`` per trial, best first. Only trials with every fold done are ranked."""
+    per_trial = {}
+    for r in results:
+        trial = per_trial.setdefault(r['trial'], {'trial': r['trial'], 'params': r['params'], 'n_folds': r['n_folds'], 'scores': {}})
+        trial['scores'][r['fold']] = r['metrics'][metric]
+    summary = []
+    for trial in per_trial.values():
+        if len(trial['scores']) == trial['n_folds']:
+            scores = list(trial['scores'].values())
+            summary.append({'trial': trial['trial'], 'params': trial['params'],
+                            'mean': float(np.mean(scores)), 'std': float(np.std(scores))})
+    return sorted(summary, key=lambda s: s['mean'], reverse=True)
+
+
+def hyperparameter_search(csv_path="files/SMOTE.csv", cache_dir="files/cache", results_dir="files/search",
+                          param_grid=None, n_trials=20, n_splits=5, n_workers=None, seed=42):
+    """
+    Patient-grouped cross-validated random search for the XGBoost malignancy model.
+
+    Every (trial, fold) pair runs as an independent job on a process pool; the workers share
+    the memory-mapped training matrix. Each finished fold is appended to ``trials.jsonl`` so an
+    interrupted search resumes from the folds that are still missing. Folds and results live in
+    ``results_dir/<search_signature>``: a new CSV, seed or number of splits starts a new search
+    instead of reusing results computed on other splits.
+
+    Returns:
+    - list: Trial summary sorted by mean balanced accuracy (see summarize).
+    """
+    from sklearn.model_selection import ParameterSampler
+
+    X, y, groups, meta = load_training_matrix(csv_path, cache_dir)
+    signature, description = search_signature(meta, n_splits, seed)
+    results_dir = Path(results_dir) / signature
+    results_dir.mkdir(parents=True, exist_ok=True)
+    with open(results_dir / 'signature.json', 'w') as f:
+        json.dump(description, f, indent=4)
+
+    # Folds are stored so that resumed searches evaluate on exactly the same splits
+    folds_path = results_dir / 'folds.npy'
+    if folds_path.exists():
+        folds = np.load(folds_path)
+    else:
+        folds = make_folds(y, groups, n_splits, seed)
+        np.save(folds_path, folds)
+
+    results_path = results_dir / 'trials.jsonl'
+    done = {(r['trial'], r['fold']) for r in load_results(results_path)}
+    candidates = list(ParameterSampler(param_grid or PARAM_GRID, n_iter=n_trials, random_state=seed))
+    jobs = [(params, fold) for params in candidates for fold in range(n_splits)
+            if (trial_key(params), fold) not in done]
+    print("{} trials x {} folds, {} jobs left".format(len(candidates), n_splits, len(jobs)))
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(csv_path, cache_dir)) as pool:
+        futures = {pool.submit(run_fold, params, fold, folds, seed): (params, fold) for params, fold in jobs}
+        with open(results_path, 'a') as f:
+            for future in as_completed(futures):
+                params, fold = futures[future]
+                record = {'trial': trial_key(params), 'params': params, 'fold': fold,
+                          'n_folds': n_splits, 'metrics': future.result()}
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+
+    summary = summarize(load_results(results_path))
+    with open(results_dir / 'summary.json', 'w') as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
+def fit_final(params, csv_path="files/SMOTE.csv", cache_dir="files/cache", model_dir="files/model", seed=42, n_threads=-1):
+    """
+    Fit the final model on all labeled rows (SMOTE applied) and save it as
+    ``xgb_model.json`` plus ``model_meta.json`` (feature names, class mapping, params).
+    """
+    from xgboost import XGBClassifier
+
+    X, y, groups, meta = load_training_matrix(csv_path, cache_dir)
+    X_res, y_res = apply_smote(np.asarray(X), np.asarray(y), seed)
+    n_classes = len(meta['class_mapping'])
+    model = XGBClassifier(**params, random_state=seed, n_jobs=n_threads,
+                          eval_metric='logloss' if n_classes == 2 else 'mlogloss')
+    model.fit(X_res, y_res)
+
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    model.save_model(model_dir / 'xgb_model.json')
+    with open(model_dir / 'model_meta.json', 'w') as f:
+        json.dump({'feature_names': meta['feature_names'], 'class_mapping': meta['class_mapping'], 'params': params}, f, indent=4)
+    return model
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Patient-grouped hyperparameter search for the XGBoost malignancy model')
+    arg_parser.add_argument('--csv', default='files/SMOTE.csv')
+    arg_parser.add_argument('--cache-dir', default='files/cache')
+    arg_parser.add_argument('--results-dir', default='files/search')
+    arg_parser.add_argument('--model-dir', default='files/model')
+    arg_parser.add_argument('--n-trials', type=int, default=20)
+    arg_parser.add_argument('--n-splits', type=int, default=5)
+    arg_parser.add_argument('--workers', type=int, default=None)
+    arg_parser.add_argument('--seed', type=int, default=42)
+    arg_parser.add_argument('--no-final', action='store_true', help='Do not refit the best trial on all data')
+    args = arg_parser.parse_args()
+
+    summary = hyperparameter_search(args.csv, args.cache_dir, args.results_dir, n_trials=args.n_trials,
+                                    n_splits=args.n_splits, n_workers=args.workers, seed=args.seed)
+    for s in summary[:5]:
+        print("{}  {:.4f} +/- {:.4f}  {}".format(s['trial'], s['mean'], s['std'], s['params']))
+    if summary and not args.no_final:
+        fit_final(summary[0]['params'], args.csv, args.cache_dir, args.model_dir, args.seed)
+        print("Saved model to", args.model_dir)
@@ -1,20 +1,23 @@
 import argparse
 import os
+from pathlib import Path
 import numpy as np
 
-from medpy.filter.smoothing import anisotropic_diffusion
-from scipy.ndimage import median_filter
-from skimage import measure, morphology
-import scipy.ndimage as ndimage
-from sklearn.cluster import KMeans
-
-import pydicom
 from statistics import  median_high
 
-from Mask import extract_radiomics
+from dtype_policy import DtypePolicy, DEFAULT_POLICY, LEGACY_POLICY
 
 import json
 
+# Heavy dependencies (pydicom, scipy, skimage, medpy, sklearn, radiomics) are imported
+# inside the functions that use them, so importing utils stays cheap for workers and CLIs.
+
+
+def extract_radiomics(scan_array, mask_array, *args, **kwargs):
+    """Lazy wrapper around ``Mask.extract_radiomics`` (pyradiomics is only loaded when called)."""
+    from Mask import extract_radiomics as _extract_radiomics
+    return _extract_radiomics(scan_array, mask_array, *args, **kwargs)
+
 def is_dir_path(string):
     if os.path.isdir(string):
         return string
@@ -58,18 +61,25 @@ def clip_hu_range(hu_image, min_hu=-1000, max_hu=400):
 
 
 # Convert DICOM image to Hounsfield Units (HU)
-def convert_to_HU(archive):
+def convert_to_HU(archive, policy=None, return_rescale=False):
     """
     Convert a DICOM image to Hounsfield Units (HU).
     
     Args:
         archive (Path or str): Path to the DICOM file.
+        policy (DtypePolicy, optional): Dtype policy. Default is DEFAULT_POLICY (int16 HU),
+            use LEGACY_POLICY for the original float64 output.
+        return_rescale (bool, optional): Also return the (slope, intercept) metadata.
         
     Returns:
-        numpy array: The CT image converted to Hounsfield Units (HU).
+        numpy array: The CT image converted to Hounsfield Units (HU), in ``policy.storage_dtype``.
+        If ``return_rescale`` is True, a tuple ``(hu_image, (slope, intercept))``.
     """
+    import pydicom
+
+    policy = policy or DEFAULT_POLICY
     # Read the DICOM file
-    dicom_file = pydicom.dcmread(archive.resolve())
+    dicom_file = pydicom.dcmread(Path(archive).resolve())
     # Extract the pixel data from the DICOM file
     image_array = dicom_file.pixel_array
 
@@ -79,13 +89,67 @@ def convert_to_HU(archive):
 
     # Apply the conversion formula to transform to Hounsfield Units (HU)
     # HU = PixelValue * RescaleSlope + RescaleIntercept
-    hu_image = image_array * slope + intercept
+    hu_image = policy.rescale(image_array, float(slope), float(intercept))
 
+    if return_rescale:
+        return hu_image, (float(slope), float(intercept))
     return hu_image
 
 
+# Read a whole DICOM series as a HU volume
+def load_dicom_series(series_dir, policy=None, series_uid=None, expected_slices=None):
+    """
+    Read the DICOM slices of a series and stack them into a HU volume.
+
+    Slices are sorted by their z position (ImagePositionPatient), giving the same
+    (rows, columns, slices) layout as ``pylidc.Scan.to_volume``. A LIDC patient
+    directory can hold several series (and some patients two CT scans): pass
+    ``series_uid`` (``scan.series_instance_uid``) to keep only the slices of one of them.
+
+    Args:
+        series_dir (Path or str): Directory containing the DICOM files (searched recursively).
+        policy (DtypePolicy, optional): Dtype policy. Default is DEFAULT_POLICY (int16 HU).
+        series_uid (str, optional): Only read slices with this SeriesInstanceUID.
+        expected_slices (int, optional): Raise ValueError if the series has another number of slices
+            (e.g. the length of ``scan.sorted_dicom_file_names``).
+
+    Returns:
+        numpy array: The HU volume in ``policy.storage_dtype``.
+    """
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+
+    policy = policy or DEFAULT_POLICY
+    slices = []
+    for archive in Path(series_dir).rglob('*'):
+        if not archive.is_file():
+            continue
+        try:
+            dicom_file = pydicom.dcmread(archive.resolve())
+        except InvalidDicomError:
+            continue  # Ignore non-DICOM files (xml annotations, etc.)
+        if 'PixelData' not in dicom_file or 'ImagePositionPatient' not in dicom_file:
+            continue
+        if series_uid is not None and dicom_file.get('SeriesInstanceUID') != series_uid:
+            continue
+        slices.append(dicom_file)
+    if not slices:
+        raise FileNotFoundError("No DICOM images found in {}".format(series_dir))
+    if expected_slices is not None and len(slices) != expected_slices:
+        raise ValueError("{} slices found in {} (series {}), expected {}".format(
+            len(slices), series_dir, series_uid, expected_slices))
+
+    slices.sort(key=lambda d: float(d.ImagePositionPatient[2]))
+    vol = np.empty(slices[0].pixel_array.shape + (len(slices),), dtype=policy.storage_dtype)
+    for idx, dicom_file in enumerate(slices):
+        intercept = dicom_file.RescaleIntercept if 'RescaleIntercept' in dicom_file else 0
+        slope = dicom_file.RescaleSlope if 'RescaleSlope' in dicom_file else 1
+        vol[:, :, idx] = policy.rescale(dicom_file.pixel_array, float(slope), float(intercept))
+    return vol
+
+
 # Normalize HU values between 0 and 1
-def normalize_hu(hu_image, min_hu=-1000, max_hu=400):
+def normalize_hu(hu_image, min_hu=-1000, max_hu=400, policy=None):
     """
     Normalize the Hounsfield Unit (HU) values of a CT image to the range [0, 1].
     
@@ -93,10 +157,13 @@ def normalize_hu(hu_image, min_hu=-1000, max_hu=400):
         hu_image (numpy array): The input CT image in HU.
         min_hu (int, optional): The minimum HU value for normalization. Default is -1000.
         max_hu (int, optional): The maximum HU value for normalization. Default is 400.
+        policy (DtypePolicy, optional): If given, the result is computed in ``policy.compute_dtype``.
         
     Returns:
         numpy array: The CT image with HU values normalized between 0 and 1.
     """
+    if policy is not None:
+        hu_image = policy.to_compute(hu_image)
     # Normalize the HU values to the range [0, 1]
     hu_image = (hu_image - min_hu) / (max_hu - min_hu)
     
@@ -108,13 +175,25 @@ def normalize_hu(hu_image, min_hu=-1000, max_hu=400):
 
 
 
-def segment_lung(img):
+def segment_lung(img, policy=None, return_stats=False):
     #function sourced from https://www.kaggle.com/c/data-science-bowl-2017#tutorial
     """
     This segments the Lung Image(Don't get confused with lung nodule segmentation)
+
+    The image is processed in ``policy.compute_dtype`` (float32 by default, LEGACY_POLICY
+    gives the original float64 output). With ``return_stats`` the standardization
+    parameters ``{'mean': ..., 'std': ...}`` are returned as well.
     """
+    from medpy.filter.smoothing import anisotropic_diffusion
+    from scipy.ndimage import median_filter
+    from skimage import measure, morphology
+    from sklearn.cluster import KMeans
+
+    policy = policy or DEFAULT_POLICY
+    img = policy.to_compute(img)
     mean = np.mean(img)
     std = np.std(img)
+    stats = {'mean': float(mean), 'std': float(std)}
     img = img-mean
     img = img/std
     
@@ -156,7 +235,11 @@ def segment_lung(img):
         mask = mask + np.where(labels==N,1,0)
     mask = morphology.dilation(mask,np.ones([10,10])) # one last dilation
     # mask consists of 1 and 0. Thus by mutliplying with the orginial image, sections with 1 will remain
-    return mask*img
+    # (cast the mask first, an int64 mask would promote the result to float64)
+    segmented = mask.astype(policy.compute_dtype) * policy.to_compute(img)
+    if return_stats:
+        return segmented, stats
+    return segmented
 
 def count_params(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -185,6 +268,81 @@ def load_json(json_path):
         data = json.load(json_file)
     return data
 
+class _IncompleteJSON(Exception):
+    """The buffer ends before the current JSON item does."""
+
+
+def _skip_whitespace(buffer, pos):
+    while pos < len(buffer) and buffer[pos] in ' \t\n\r':
+        pos += 1
+    return pos
+
+
+def _decode_json_item(decoder, buffer, pos, eof):
+    """Decode one ``"key": value`` pair of an object starting at ``pos``. Returns None at the closing brace."""
+    pos = _skip_whitespace(buffer, pos)
+    if pos < len(buffer) and buffer[pos] == ',':
+        pos = _skip_whitespace(buffer, pos + 1)
+    if pos >= len(buffer):
+        raise _IncompleteJSON()
+    if buffer[pos] == '}':
+        return None
+    try:
+        key, pos = decoder.raw_decode(buffer, pos)
+        pos = _skip_whitespace(buffer, pos)
+        if pos >= len(buffer):
+            raise _IncompleteJSON()
+        if buffer[pos] != ':':
+            raise ValueError("Expected ':' after key {!r}".format(key))
+        pos = _skip_whitespace(buffer, pos + 1)
+        value, end = decoder.raw_decode(buffer, pos)
+    except json.JSONDecodeError:
+        raise _IncompleteJSON()
+    if end >= len(buffer) and not eof:
+        # A number at the very end of the buffer may still continue in the next chunk
+        raise _IncompleteJSON()
+    return key, value, end
+
+
+def iter_json_items(json_path, chunk_size=1 << 20):
+    """
+    Iterate over the top-level ``key, value`` pairs of a JSON object without loading the whole file.
+
+    Only one top-level value (e.g. one patient of the radiomics JSON) is kept in memory at a time.
+
+    Parameters:
+    - json_path (str): Ruta al archivo JSON.
+    - chunk_size (int): Number of characters read from disk at a time.
+
+    Yields:
+    - tuple: (key, value) for each entry of the top-level object.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_path, 'r') as json_file:
+        buffer = json_file.read(chunk_size)
+        eof = not buffer
+        pos = _skip_whitespace(buffer, 0)
+        if buffer[pos:pos + 1] != '{':
+            raise ValueError("{} does not contain a JSON object".format(json_path))
+        pos += 1
+        while True:
+            try:
+                item = _decode_json_item(decoder, buffer, pos, eof)
+            except _IncompleteJSON:
+                if eof:
+                    raise ValueError("Truncated or malformed JSON file: {}".format(json_path))
+                # Grow the read size with the buffer so that large items are decoded in linear time
+                chunk = json_file.read(max(chunk_size, len(buffer)))
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            if item is None:
+                return
+            key, value, pos = item
+            yield key, value
+
+
 def dump_json(output_json_path) : 
     # Volcar el diccionario data_storer a un archivo JSON
     with open(output_json_path, 'w') as json_file: